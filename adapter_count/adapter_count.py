@@ -2,11 +2,37 @@
 
 """
 adapter_count.py - change the number of adapters
+
+usage: adapter_count [-a num] [-j num] [-J file] version parameter-file project-id [sel-item ...]
+       adapter_count -R file version parameter-file project-id
+
+  -a num, --adapters=num    new number of adapters, doesn't ask for it
+  -j num, --jobs=num        maximum number of concurrent requests (default 8)
+  -J file, --journal=file   journal file, default is adapter_count-<project>.journal
+                            in the temp directory
+  -R file, --rollback=file  roll back the changes recorded in a journal
+
+Multiple stopped nodes can be changed at once. Only the links on
+adapters above the new count are deleted and reported. When the
+adapter count changes, the compute rebuilds the adapters of the node
+and drops their connections, so the other links of the node are
+deleted and recreated concurrently after the update.
+
+All steps are recorded in a journal. When a step fails, the changes
+are rolled back automatically. If that's not possible, the journal is
+kept and can be rolled back later with --rollback. A rollback, that
+failed partway, can be repeated.
 """
 
+import getopt
+import json
 import os
 import sys
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
 import gns3api
+from api_helpers import ThreadConnections
 from qt_widgets import SimpleWidgets
 
 def die(text):
@@ -14,83 +40,360 @@ def die(text):
     SimpleWidgets().alert(None, text)
     sys.exit(text)
 
+def adapter_property(node):
+    """ name of the adapter property of a node """
+    return 'ethernet_adapters' if node['node_type'] == "iou" else 'adapters'
 
-# get command line parameter
-if len(sys.argv) < 4:
-    die("usage:\ncadapter_count version parameter-file project-id [sel-item ...]")
-try:
-    with open(sys.argv[2], "r") as file:
-        cntl_url, cntl_user, cntl_passwd, *_ = file.read(512).splitlines()
-    if sys.argv[2].endswith(".tmp"):
-        os.remove(sys.argv[2])
-except (OSError, ValueError) as err:
-    sys.exit("Can't get controller connection params: {}".format(err))
-project_id = sys.argv[3]
-sel_items = sys.argv[4:]
-
-# get node id from command line
-sel_nodes = [item[6:] for item in sel_items
-             if item.startswith("nodes/")]
-if len(sel_nodes) != 1:
-    die("Exactly one node must be selected")
-node_id = sel_nodes[0]
-
-# connect to GNS3 controller
-try:
-    api = gns3api.GNS3Api(cntl_url, cntl_user, cntl_passwd)
-except gns3api.GNS3ApiException as err:
-    die("Can't connect to GNS3 controller: {}".format(err))
+def link_endpoint(link, node_id):
+    """ return the endpoint of the link at the node """
+    for endpoint in link['nodes']:
+        if endpoint['node_id'] == node_id:
+            return endpoint
+    return None
 
-# get node information
-try:
-    node = api.request('GET', ('/v2/projects', project_id, 'nodes', node_id))
-except gns3api.GNS3ApiException as err:
-    die("Can't get node information: {}".format(err))
-
-if node['node_type'] not in ("docker", "iou", "qemu"):
-    die("Only the node types Docker, IOU and QEMU are supported")
-
-if node['status'] != "stopped":
-    die("Node must be stopped")
-
-# New number of adapters
-adapter_property = 'adapters'
-if node['node_type'] == "iou":
-    adapter_property = 'ethernet_adapters'
-cur_adapters = node['properties'][adapter_property]
-adapters = SimpleWidgets().get_int(None, "Adapters", cur_adapters, 1)
-if adapters is None or adapters == cur_adapters:
-    sys.exit(0)			# Nothing to do
-
-# Get links of the node
-try:
-    links = api.request('GET', ('/v2/projects', project_id, 'nodes', node_id, 'links'))
-except gns3api.GNS3ApiException as err:
-    die("Can't get link information: {}".format(err))
+def link_text(link, node_names):
+    """ text describing a link """
+    return " - ".join("{} {}".format(
+        node_names.get(endpoint['node_id'], endpoint['node_id']),
+        (endpoint.get('label') or {}).get('text') or
+        "{}/{}".format(endpoint['adapter_number'], endpoint['port_number']))
+                      for endpoint in link['nodes'])
 
-# delete links of the node
-try:
+def link_key(link):
+    """ the endpoints of a link, identifying it """
+    return frozenset((endpoint['node_id'], endpoint['adapter_number'],
+                      endpoint['port_number'])
+                     for endpoint in link['nodes'])
+
+def new_link(link):
+    """ link data for recreating a link """
+    return {key: val for key, val in link.items()
+            if key in ('nodes', 'filters', 'suspend', 'link_style')}
+
+class Transaction:
+    """
+    executes the requests concurrently, all changes are recorded
+    in a journal (JSON lines) for the rollback
+    """
+
+    def __init__(self, connect, project_id, journal_file, jobs=8):
+        self._conns = ThreadConnections(connect)
+        self._project_id = project_id
+        self._executor = ThreadPoolExecutor(max_workers=jobs)
+        self._lock = threading.Lock()
+        self.journal_file = journal_file
+        self.journal = []
+        self._file = None
+
+    def open(self):
+        """ create the journal file """
+        self._file = open(self.journal_file, "w")
+        self._record({'project_id': self._project_id})
+
+    def close(self, remove=False):
+        """ close the journal file, on success it's removed """
+        self._executor.shutdown()
+        if self._file:
+            self._file.close()
+            self._file = None
+        if remove:
+            os.remove(self.journal_file)
+
+    def load(self):
+        """ load a journal file """
+        with open(self.journal_file, "r") as file:
+            header, *self.journal = [json.loads(line) for line in file if line.strip()]
+        if header.get('project_id') != self._project_id:
+            raise ValueError("journal of another project")
+
+    def _record(self, step):
+        """ add a step to the journal """
+        with self._lock:
+            if 'action' in step:
+                self.journal.append(step)
+            if self._file:
+                self._file.write(json.dumps(step) + "\n")
+                self._file.flush()
+
+    def _request(self, request):
+        """ API request in a worker thread, returns (result, error) """
+        method, path, data, step = request
+        try:
+            result = self._conns.request(method, path, data)
+        except gns3api.GNS3ApiException as err:
+            return (None, err)
+        if step:
+            if step['action'] == 'create_link':
+                step['link_id'] = result['link_id']
+            self._record(step)
+        return (result, None)
+
+    def run(self, requests):
+        """
+        run requests (method, path, data, journal step) concurrently
+
+        Returns a list of (result, error).
+        """
+        return list(self._executor.map(self._request, requests))
+
+    def delete_links(self, links):
+        """ delete links, returns a list of (result, error) """
+        return self.run([('DELETE', ('/v2/projects', self._project_id, 'links', link['link_id']),
+                          None, {'action': 'delete_link', 'link': new_link(link)})
+                         for link in links])
+
+    def create_links(self, links):
+        """ create links, returns a list of (result, error) """
+        return self.run([('POST', ('/v2/projects', self._project_id, 'links'),
+                          new_link(link), {'action': 'create_link'})
+                         for link in links])
+
+    def update_nodes(self, updates):
+        """
+        update the adapter count, updates is a list of
+        (node_id, property, old count, new count)
+        Returns a list of (result, error).
+        """
+        return self.run([('PUT', ('/v2/projects', self._project_id, 'nodes', node_id),
+                          {'properties': {prop: new}},
+                          {'action': 'update_node', 'node_id': node_id,
+                           'property': prop, 'old': old, 'new': new})
+                         for node_id, prop, old, new in updates])
+
+    def _undo(self, requests, node_names):
+        """
+        run undo requests, returns a list of error messages
+
+        Deleting a link, that doesn't exist anymore, is no error.
+        """
+        errors = []
+        for request, (_, err) in zip(requests, self.run(requests)):
+            if not err or (isinstance(err, gns3api.HTTPError) and
+                           err.args[0] == 404 and request[0] == 'DELETE'):
+                continue
+            if request[0] == 'POST':
+                errors.append("Can't restore link {}: {}".format(
+                    link_text(request[2], node_names or {}), err))
+            else:
+                errors.append(str(err))
+        return errors
+
+    def rollback(self, node_names=None):
+        """
+        undo the steps of the journal, returns a list of error messages
+
+        The created links are deleted, the adapter counts restored
+        and then the deleted links recreated, unless they already
+        exist. So a rollback, that failed partway, can be repeated
+        with the same journal.
+        """
+        project = ('/v2/projects', self._project_id)
+        errors = self._undo(
+            [('DELETE', project + ('links', step['link_id']), None, None)
+             for step in self.journal if step['action'] == 'create_link'],
+            node_names)
+        if errors:
+            return errors
+        errors = self._undo(
+            [('PUT', project + ('nodes', step['node_id']),
+              {'properties': {step['property']: step['old']}}, None)
+             for step in reversed(self.journal) if step['action'] == 'update_node'],
+            node_names)
+        if errors:
+            return errors
+        try:
+            existing = {link_key(link) for link in
+                        self._conns.request('GET', project + ('links',))}
+        except gns3api.GNS3ApiException as err:
+            return ["Can't get link information: {}".format(err)]
+        return self._undo(
+            [('POST', project + ('links',), step['link'], None)
+             for step in self.journal if step['action'] == 'delete_link'
+             and link_key(step['link']) not in existing],
+            node_names)
+
+def resize(trans, nodes, links, adapters, node_names=None):
+    """
+    change the number of adapters of the nodes
+
+    Returns the deleted links, raises GNS3ApiException on error,
+    its message lists all failed link requests.
+    """
+    node_names = node_names or {}
+
+    def check(results, text, links):
+        errors = ["{} {}: {}".format(text, link_text(link, node_names), err)
+                  for link, (_, err) in zip(links, results) if err]
+        if errors:
+            raise gns3api.GNS3ApiException("\n".join(errors))
+
+    # plan: links on the removed adapters are deleted, the other links
+    # of the changed nodes are recreated, as the compute drops their
+    # connections, when it rebuilds the adapters
+    updates = [(node_id, adapter_property(node),
+                node['properties'][adapter_property(node)], adapters)
+               for node_id, node in nodes.items()
+               if node['properties'][adapter_property(node)] != adapters]
+    changed = {node_id for node_id, *_ in updates}
+    removed = {}
+    relink = {}
     for link in links:
-        api.request('DELETE', ('/v2/projects', project_id, 'links', link['link_id']))
-except gns3api.GNS3ApiException as err:
-    die("Can't delete link: {}".format(err))
+        for endpoint in link['nodes']:
+            if endpoint['node_id'] not in changed:
+                continue
+            if endpoint['adapter_number'] >= adapters:
+                removed[link['link_id']] = link
+            else:
+                relink[link['link_id']] = link
+    for link_id in removed:
+        relink.pop(link_id, None)
+    removed = list(removed.values())
+    relink = list(relink.values())
 
-# update adapter count
-update_err = None
-try:
-    api.request('PUT', ('/v2/projects', project_id, 'nodes', node_id),
-                {'properties': {adapter_property: adapters}})
-except gns3api.GNS3ApiException as err:
-    update_err = "Can't update adapter count: {}".format(err)
-
-# restore the links
-for link in links:
-    del link['link_id']
+    # delete the links, update the nodes and recreate the kept links
+    check(trans.delete_links(removed + relink), "Can't delete link",
+          removed + relink)
+    errors = ["Can't update adapter count of {}: {}"
+              .format(nodes[update[0]]['name'], err)
+              for update, (_, err) in zip(updates, trans.update_nodes(updates))
+              if err]
+    if errors:
+        raise gns3api.GNS3ApiException("\n".join(errors))
+    check(trans.create_links(relink), "Can't restore link", relink)
+    return removed
+
+def adapter_count(argv):
+    """ parse command line, retrieve nodes and change the adapter count """
+
+    # get command line parameter
+    usage = "usage:\nadapter_count [-a num] [-j num] [-J file] " \
+            "version parameter-file project-id [sel-item ...]\n" \
+            "adapter_count -R file version parameter-file project-id"
+    try:
+        opts, args = getopt.getopt(argv[1:], "a:j:J:R:",
+                                   ["adapters=", "jobs=", "journal=", "rollback="])
+        opts = dict(opts)
+        adapters = opts.get('-a', opts.get('--adapters'))
+        if adapters is not None:
+            adapters = int(adapters)
+        jobs = int(opts.get('-j', opts.get('--jobs', 8)))
+    except (getopt.GetoptError, ValueError) as err:
+        die("{}\n{}".format(err, usage))
+    rollback_file = opts.get('-R', opts.get('--rollback'))
+    argv = argv[:1] + args
+    if len(argv) < 4 or jobs < 1 or (adapters is not None and adapters < 1):
+        die(usage)
+    try:
+        with open(argv[2], "r") as file:
+            cntl_url, cntl_user, cntl_passwd, *_ = file.read(512).splitlines()
+        if argv[2].endswith(".tmp"):
+            os.remove(argv[2])
+    except (OSError, ValueError) as err:
+        sys.exit("Can't get controller connection params: {}".format(err))
+    project_id = argv[3]
+    sel_items = argv[4:]
+    journal_file = opts.get('-J', opts.get('--journal')) or \
+                   os.path.join(tempfile.gettempdir(),
+                                "adapter_count-{}.journal".format(project_id))
+
+    def connect():
+        return gns3api.GNS3Api(cntl_url, cntl_user, cntl_passwd)
+
+    # connect to GNS3 controller
+    try:
+        api = connect()
+    except gns3api.GNS3ApiException as err:
+        die("Can't connect to GNS3 controller: {}".format(err))
+
+    # roll back a journal
+    if rollback_file:
+        trans = Transaction(connect, project_id, rollback_file, jobs)
+        try:
+            trans.load()
+        except (OSError, ValueError, KeyError) as err:
+            die("Can't read journal: {}".format(err))
+        try:
+            node_names = {node['node_id']: node['name'] for node in
+                          api.request('GET', ('/v2/projects', project_id, 'nodes'))}
+        except gns3api.GNS3ApiException as err:
+            die("Can't get node information: {}".format(err))
+        errors = trans.rollback(node_names)
+        if errors:
+            die("Rollback failed:\n" + "\n".join(errors))
+        trans.close(remove=True)
+        return
+
+    # get node ids from command line
+    sel_nodes = [item[6:] for item in sel_items
+                 if item.startswith("nodes/")]
+    if not sel_nodes:
+        die("No node selected")
+
+    # get node information
+    try:
+        all_nodes = {node['node_id']: node for node in
+                     api.request('GET', ('/v2/projects', project_id, 'nodes'))}
+        nodes = {node_id: all_nodes[node_id] for node_id in sel_nodes}
+    except gns3api.GNS3ApiException as err:
+        die("Can't get node information: {}".format(err))
+    except KeyError as err:
+        die("Node {} not found".format(err))
+
+    for node in nodes.values():
+        if node['node_type'] not in ("docker", "iou", "qemu"):
+            die("{}: Only the node types Docker, IOU and QEMU are supported"
+                .format(node['name']))
+        if node['status'] != "stopped":
+            die("{}: Node must be stopped".format(node['name']))
+
+    # New number of adapters
+    cur_adapters = max(node['properties'][adapter_property(node)]
+                       for node in nodes.values())
+    if adapters is None:
+        adapters = SimpleWidgets().get_int(None, "Adapters", cur_adapters, 1)
+    if adapters is None or \
+       all(node['properties'][adapter_property(node)] == adapters
+           for node in nodes.values()):
+        sys.exit(0)			# Nothing to do
+
+    # Get links of the nodes
     try:
-        api.request('POST', ('/v2/projects', project_id, 'links'), link)
+        if len(nodes) == 1:
+            links = api.request('GET', ('/v2/projects', project_id,
+                                        'nodes', sel_nodes[0], 'links'))
+        else:
+            links = [link for link in
+                     api.request('GET', ('/v2/projects', project_id, 'links'))
+                     if any(endpoint['node_id'] in nodes
+                            for endpoint in link['nodes'])]
     except gns3api.GNS3ApiException as err:
-        if not isinstance(err, gns3api.HTTPError) or err.args[0] != 404:
-            die("Can't restore link: {}".format(err))
+        die("Can't get link information: {}".format(err))
 
-if update_err:
-    die(update_err)
+    # change the adapters
+    trans = Transaction(connect, project_id, journal_file, jobs)
+    try:
+        trans.open()
+    except OSError as err:
+        die("Can't create journal: {}".format(err))
+    node_names = {node_id: node['name'] for node_id, node in all_nodes.items()}
+    try:
+        removed = resize(trans, nodes, links, adapters, node_names)
+    except gns3api.GNS3ApiException as err:
+        rollback_errors = trans.rollback(node_names)
+        if rollback_errors:
+            trans.close()
+            die("{}\nRollback failed:\n{}\nJournal: {}"
+                .format(err, "\n".join(rollback_errors), journal_file))
+        trans.close(remove=True)
+        die(str(err))
+    trans.close(remove=True)
+
+    # report the deleted links
+    if removed:
+        SimpleWidgets().info(None, "Deleted links:\n" + "\n".join(
+            link_text(link, node_names) for link in removed))
+
+try:
+    adapter_count(sys.argv)
+except KeyboardInterrupt:
+    sys.stderr.write("Aborted\n")
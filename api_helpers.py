@@ -0,0 +1,129 @@
+"""
+api_helpers.py - helpers for the GNS3 API
+
+ThreadConnections keeps an API connection per worker thread.
+
+StreamClient sends GET requests to the controller and returns the
+response unread, so that large files and notification streams can be
+processed while they arrive. It uses the connection settings of
+gns3api: the controller URL including its path, HTTP or HTTPS and
+basic authentication.
+"""
+
+import base64
+import http.client
+import ssl
+import threading
+import urllib.parse
+import gns3api
+
+class ThreadConnections:
+    """
+    API connections of the worker threads
+
+    connect is a function returning a new connection, every thread
+    creates its own on first use. After a connection error it's
+    created again, HTTP errors keep the connection.
+    """
+
+    def __init__(self, connect):
+        self._connect = connect
+        self._local = threading.local()
+
+    def get(self):
+        """ connection of the current thread """
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = self._connect()
+            self._local.conn = conn
+        return conn
+
+    def reset(self):
+        """ drop the connection of the current thread """
+        self._local.conn = None
+
+    def request(self, *args):
+        """ API request using the connection of the current thread """
+        try:
+            return self.get().request(*args)
+        except gns3api.GNS3ApiException as err:
+            if not isinstance(err, gns3api.HTTPError):
+                self.reset()
+            raise
+
+class StreamClient:
+    """
+    HTTP client to stream responses from the controller
+
+    Every thread uses its own connection, that is kept alive.
+    Connection errors raise a gns3api.GNS3ApiException.
+    """
+
+    def __init__(self, url, user=None, passwd=None, verify=True, timeout=60):
+        url = urllib.parse.urlsplit(url)
+        if url.scheme not in ('http', 'https') or not url.hostname:
+            raise gns3api.GNS3ApiException(
+                "Invalid controller URL '{}'".format(url.geturl()))
+        self._https = url.scheme == 'https'
+        self._host = url.hostname
+        self._port = url.port or 3080
+        self._prefix = url.path.rstrip('/')
+        self._timeout = timeout
+        self._context = None
+        if self._https:
+            self._context = ssl.create_default_context()
+            if not verify:
+                self._context.check_hostname = False
+                self._context.verify_mode = ssl.CERT_NONE
+        self._headers = {}
+        if user:
+            auth = base64.b64encode("{}:{}".format(user, passwd).encode())
+            self._headers['Authorization'] = "Basic " + auth.decode('ascii')
+        self._conns = ThreadConnections(self.connection)
+
+    def connection(self):
+        """ create a new connection, e.g. for a long running stream """
+        if self._https:
+            return http.client.HTTPSConnection(self._host, self._port,
+                                               timeout=self._timeout,
+                                               context=self._context)
+        return http.client.HTTPConnection(self._host, self._port,
+                                          timeout=self._timeout)
+
+    def path(self, path):
+        """ request path, a tuple is joined and its items quoted """
+        if not isinstance(path, str):
+            path = '/'.join(urllib.parse.quote(str(item).strip('/'))
+                            for item in path)
+        return self._prefix + '/' + path.lstrip('/')
+
+    def get(self, path, headers=None, conn=None):
+        """
+        send GET request, returns the response
+
+        Without conn the thread's connection is used, the caller must
+        read the response completely, before the thread sends the next
+        request. A stale connection is reopened.
+        """
+        headers = dict(self._headers, **(headers or {}))
+        if conn is not None:
+            try:
+                conn.request('GET', self.path(path), headers=headers)
+                return conn.getresponse()
+            except (OSError, http.client.HTTPException) as err:
+                conn.close()
+                raise gns3api.GNS3ApiException(
+                    "Connection error: {}".format(err)) from err
+        for retry in (True, False):
+            conn = self._conns.get()
+            reused = conn.sock is not None
+            try:
+                conn.request('GET', self.path(path), headers=headers)
+                return conn.getresponse()
+            except (OSError, http.client.HTTPException) as err:
+                conn.close()
+                self._conns.reset()
+                if not (retry and reused):	# retry on a stale connection
+                    raise gns3api.GNS3ApiException(
+                        "Connection error: {}".format(err)) from err
+        return None
@@ -0,0 +1,184 @@
+"""
+async_telnet.py - simple telnet client based on asyncio
+
+A replacement of telnetlib, which is removed in Python 3.13.
+Received data is available as soon as it arrives, expect wakes up
+on a match instead of waiting for a timeout.
+"""
+
+import asyncio
+
+IAC, DONT, DO, WONT, WILL, SB, SE = 255, 254, 253, 252, 251, 250, 240
+ECHO, SGA = 1, 3
+
+class TelnetClient:
+    """ Telnet client """
+
+    # options the client accepts on the server side resp. on its side
+    server_options = (ECHO, SGA)
+    client_options = (SGA,)
+
+    def __init__(self):
+        self._reader = None
+        self._writer = None
+        self._raw = bytearray()		# received data, not yet processed
+        self._buffer = bytearray()	# received data without telnet commands
+        self._scanned = 0		# buffer position already scanned by expect
+        self._options = {}		# negotiated options
+        self.eof = False
+        self.on_receive = None		# callback, called when data arrives
+
+    async def open(self, host, port, timeout=None):
+        """ open connection """
+        self._reader, self._writer = await asyncio.wait_for(
+            asyncio.open_connection(host, port), timeout)
+
+    def close(self):
+        """ close connection """
+        if self._writer:
+            self._writer.close()
+            self._writer = None
+
+    def write(self, data):
+        """ send data, IAC characters are doubled """
+        self._writer.write(data.replace(bytes((IAC,)), bytes((IAC, IAC))))
+
+    async def drain(self):
+        """ wait until the send buffer is flushed """
+        await self._writer.drain()
+
+    def _negotiate(self, cmd, option):
+        """ answer an option negotiation """
+        if cmd in (WILL, WONT):
+            accept = cmd == WILL and option in self.server_options
+            key = ('server', option)
+            reply = DO if accept else DONT
+        else:
+            accept = cmd == DO and option in self.client_options
+            key = ('client', option)
+            reply = WILL if accept else WONT
+        if self._options.get(key) != accept:
+            self._options[key] = accept
+            self._writer.write(bytes((IAC, reply, option)))
+
+    def _process(self):
+        """ move received data to the buffer, handle telnet commands """
+        raw = self._raw
+        pos = 0
+        while pos < len(raw):
+            if raw[pos] != IAC:
+                end = raw.find(IAC, pos)
+                if end < 0:
+                    end = len(raw)
+                self._buffer += raw[pos:end].replace(b"\r\0", b"\r")
+                pos = end
+                continue
+            if pos + 1 >= len(raw):
+                break
+            cmd = raw[pos+1]
+            if cmd == IAC:
+                self._buffer.append(IAC)
+                pos += 2
+            elif cmd in (DO, DONT, WILL, WONT):
+                if pos + 2 >= len(raw):
+                    break
+                self._negotiate(cmd, raw[pos+2])
+                pos += 3
+            elif cmd == SB:
+                end = raw.find(bytes((IAC, SE)), pos+2)
+                if end < 0:
+                    break
+                pos = end + 2
+            else:
+                pos += 2
+        del raw[:pos]
+
+    async def _fill(self, timeout=None):
+        """
+        receive data, waits at most timeout seconds
+
+        Returns False on timeout, sets eof when the connection is closed.
+        """
+        if self.eof:
+            return False
+        try:
+            data = await asyncio.wait_for(self._reader.read(65536), timeout)
+        except asyncio.TimeoutError:
+            return False
+        if not data:
+            self.eof = True
+            return False
+        self._raw += data
+        self._process()
+        if self.on_receive:
+            self.on_receive()
+        return True
+
+    def _take(self, end=None):
+        """ remove data from the buffer and return it """
+        if end is None:
+            end = len(self._buffer)
+        data = bytes(self._buffer[:end])
+        del self._buffer[:end]
+        self._scanned = 0
+        return data
+
+    def buffered(self):
+        """ number of received bytes, that are not yet read """
+        return len(self._buffer)
+
+    def read_available(self):
+        """ return data already received, doesn't wait """
+        return self._take()
+
+    async def read_some(self, timeout=None):
+        """
+        return data, wait at most timeout seconds for it
+
+        Returns b'' on timeout, raises EOFError at end of connection.
+        """
+        while not self._buffer:
+            if not await self._fill(timeout):
+                if self.eof:
+                    raise EOFError("telnet connection closed")
+                break
+        return self._take()
+
+    async def read_idle(self, idle):
+        """ read until nothing is received for idle seconds """
+        while await self._fill(idle):
+            pass
+        return self._take()
+
+    async def expect(self, patterns, timeout=None):
+        """
+        wait until one of the compiled regex patterns matches
+
+        A pattern has to match within a line, the search restarts at
+        the beginning of the last line already scanned. The match
+        refers to the text starting at that line.
+        Returns (index, match, data) of the first pattern matching,
+        data is the text up to the end of the match. On timeout
+        returns (-1, None, data received). Raises EOFError, when the
+        connection is closed and no data is available.
+        """
+        loop = asyncio.get_running_loop()
+        end_time = None if timeout is None else loop.time() + timeout
+        while True:
+            start = self._buffer.rfind(b"\n", 0, self._scanned) + 1
+            text = bytes(self._buffer[start:])
+            for index, pattern in enumerate(patterns):
+                match = pattern.search(text)
+                if match:
+                    return (index, match, self._take(start + match.end()))
+            self._scanned = len(self._buffer)
+            remaining = None
+            if end_time is not None:
+                remaining = end_time - loop.time()
+                if remaining <= 0:
+                    break
+            if not await self._fill(remaining):
+                break
+        if self.eof and not self._buffer:
+            raise EOFError("telnet connection closed")
+        return (-1, None, self._take())
@@ -2,26 +2,209 @@
 
 """
 console_port.py - change console port of one or more nodes
+
+usage: console_port [-j num] [-p port] [-H] version parameter-file project-id [sel-item ...]
+
+  -j num, --jobs=num     maximum number of concurrent updates (default 8)
+  -p port, --port=port   first console port, doesn't ask for it
+  -H, --headless         no dialogs, the result is printed as a table,
+                         needs --port
+
+The nodes are updated concurrently, at the end a summary shows the
+nodes, that failed or got another port.
 """
 
+import getopt
 import os
 import sys
+from concurrent.futures import ThreadPoolExecutor
 import gns3api
-from qt_widgets import SimpleWidgets
+from api_helpers import ThreadConnections
 
-widget = SimpleWidgets()
+widget = None
 
 def die(text):
     """ terminate program with error message """
-    widget.alert(None, text)
+    if widget:
+        widget.alert(None, text)
     sys.exit(text)
 
+def used_ports(api, project_id, project_nodes, sel_nodes):
+    """
+    get the console and aux ports used by the nodes of all opened projects
+
+    The console ports of the selected nodes are released, they get new
+    ones. VNC and spice ports are the console ports of nodes with that
+    console type, they are counted like the other console ports, other
+    ports of the nodes (e.g. a VNC display beside a telnet console)
+    are not known to the API and not counted. Returns a dict
+    compute_id -> bytearray, indexed by the port number, a used port
+    is set to 1.
+    """
+    used = {}
+    all_nodes = list(project_nodes)
+    for project in api.request('GET', ('/v2/projects',)):
+        if project['status'] == 'opened' and project['project_id'] != project_id:
+            all_nodes += api.request('GET', ('/v2/projects',
+                                             project['project_id'], 'nodes'))
+    for node in all_nodes:
+        ports = used.setdefault(node['compute_id'], bytearray(65536))
+        aux = node.get('aux') or (node.get('properties') or {}).get('aux')
+        console = None if node['node_id'] in sel_nodes else node.get('console')
+        for port in (console, aux):
+            if isinstance(port, int) and 0 < port < 65536:
+                ports[port] = 1
+    return used
+
+def plan_ports(nodes, sel_nodes, used, start, min_port, max_port):
+    """
+    assign free console ports to the selected nodes
+
+    The nodes get consecutive ports beginning at start, if such a
+    block is free on their computes. The current ports of the selected
+    nodes count as free, a node may keep its port or get the one of
+    another selected node, unless the nodes would have to swap their
+    ports in a cycle. Otherwise each node gets the next free port,
+    that is not the current port of another selected node.
+    Returns a dict node_id -> port, None if there are not enough ports.
+    """
+    def is_free(node_id, port):
+        return not used[nodes[node_id]['compute_id']][port]
+
+    def cyclic(ports):
+        """ True, if some nodes take the old ports of each other """
+        owner = {(nodes[node_id]['compute_id'], nodes[node_id]['console']): node_id
+                 for node_id in ports}
+        for node_id in ports:
+            next_id = node_id
+            for _ in range(len(ports)):
+                next_id = owner.get((nodes[next_id]['compute_id'], ports[next_id]))
+                if next_id is None or nodes[next_id]['console'] == ports[next_id]:
+                    break
+                if next_id == node_id:
+                    return True
+        return False
+
+    # search a contiguous block
+    count = len(sel_nodes)
+    last_start = max_port - count + 1
+    for first in list(range(start, last_start + 1)) + \
+                 list(range(min_port, min(start, last_start + 1))):
+        if all(is_free(node_id, first + num)
+               for num, node_id in enumerate(sel_nodes)):
+            ports = {node_id: first + num for num, node_id in enumerate(sel_nodes)}
+            if not cyclic(ports):
+                return ports
+
+    # next free port, not taken from another selected node
+    held = {(nodes[node_id]['compute_id'], nodes[node_id]['console']): node_id
+            for node_id in sel_nodes}
+    ports = {}
+    port = start
+    for node_id in sel_nodes:
+        for _ in range(max_port - min_port + 1):
+            if is_free(node_id, port) and \
+               held.get((nodes[node_id]['compute_id'], port), node_id) == node_id:
+                break
+            port = port + 1 if port < max_port else min_port
+        else:
+            return None
+        ports[node_id] = port
+        used[nodes[node_id]['compute_id']][port] = 1
+        port = port + 1 if port < max_port else min_port
+    return ports
+
+def update_ports(connect, project_id, nodes, ports, jobs):
+    """
+    update the console ports concurrently
+
+    Returns a list of (node_id, new port, error message), ordered like
+    ports. Nodes keeping their port are not updated. A node taking the
+    old port of another node is updated, after that node has moved.
+    """
+    conns = ThreadConnections(connect)
+
+    def update(node_id):
+        port = ports[node_id]
+        if nodes[node_id]['console'] == port:
+            return (node_id, port, None)
+        try:
+            node = conns.request('PUT',
+                                 ('/v2/projects', project_id, "nodes", node_id),
+                                 {"console": port})
+        except gns3api.GNS3ApiException as err:
+            if isinstance(err, gns3api.HTTPError) and err.args[0] == 409:
+                return (node_id, nodes[node_id]['console'], err.args[1])
+            return (node_id, nodes[node_id]['console'],
+                    "Can't update node information: {}".format(err))
+        if node['console'] != port:
+            return (node_id, node['console'],
+                    "Can't update console port, using {}".format(node['console']))
+        return (node_id, port, None)
+
+    results = {}
+    pending = list(ports)
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        while pending:
+            occupied = {(nodes[node_id]['compute_id'],
+                         results[node_id][1] if node_id in results
+                         else nodes[node_id]['console'])
+                        for node_id in ports}
+            ready = [node_id for node_id in pending
+                     if nodes[node_id]['console'] == ports[node_id] or
+                     (nodes[node_id]['compute_id'], ports[node_id]) not in occupied]
+            if not ready:			# port still used by a failed node
+                ready = pending
+            for result in executor.map(update, ready):
+                results[result[0]] = result
+            pending = [node_id for node_id in pending if node_id not in results]
+    return [results[node_id] for node_id in ports]
+
+def report(nodes, results, headless):
+    """ show the result, a table in headless mode or a summary dialog """
+    if headless:
+        print("{:20} {:>6} {:>6}  {}".format("Node", "Old", "New", "Result"))
+        for node_id, port, message in results:
+            print("{:20} {:>6} {:>6}  {}".format(
+                nodes[node_id]['name'], nodes[node_id]['console'], port,
+                message or ("ok" if port != nodes[node_id]['console'] else "unchanged")))
+        return
+
+    changed = sum(1 for node_id, port, message in results
+                  if not message and port != nodes[node_id]['console'])
+    text = "{} of {} nodes changed.".format(changed, len(results))
+    problems = ["{}: {}".format(nodes[node_id]['name'], message)
+                for node_id, _, message in results if message]
+    if problems:
+        text += "\n\n" + "\n".join(problems)
+    widget.info(None, text)
+
 def set_console(argv):
     """ parse command line, retrieve nodes and set console port """
+    global widget			# pylint: disable=global-statement
 
     # get arguments
-    if len(argv) < 4:
-        die("usage:\nconsole_port version parameter-file project-id [sel-item ...]")
+    usage = "usage:\nconsole_port [-j num] [-p port] [-H] " \
+            "version parameter-file project-id [sel-item ...]"
+    try:
+        opts, args = getopt.getopt(argv[1:], "j:p:H",
+                                   ["jobs=", "port=", "headless"])
+        opts = dict(opts)
+        jobs = int(opts.get('-j', opts.get('--jobs', 8)))
+        console_port = opts.get('-p', opts.get('--port'))
+        if console_port is not None:
+            console_port = int(console_port)
+    except (getopt.GetoptError, ValueError) as err:
+        sys.exit("{}\n{}".format(err, usage))
+    headless = '-H' in opts or '--headless' in opts
+    if headless and console_port is None:
+        sys.exit("Headless mode needs --port\n" + usage)
+    if not headless:
+        from qt_widgets import SimpleWidgets
+        widget = SimpleWidgets()
+    argv = argv[:1] + args
+    if len(argv) < 4 or jobs < 1:
+        die(usage)
     try:
         with open(argv[2], "r") as file:
             cntl_url, cntl_user, cntl_passwd, *_ = file.read(512).splitlines()
@@ -60,7 +243,8 @@ def set_console(argv):
             die("No node selected")
 
     sel_nodes = [node_id for node_id in sel_nodes
-                 if nodes[node_id]['console']]
+                 if nodes[node_id]['console'] and
+                 nodes[node_id]['node_type'] != 'ethernet_switch']
     if not sel_nodes:
         die("No node with console port " + msg_type)
     sel_nodes.sort(key=lambda k: nodes[k]['name'].lower())
@@ -68,32 +252,30 @@ def set_console(argv):
     # New console port
     min_port = 5000
     max_port = 10000
-    console_port = widget.get_int(None, "Console port", min_port,
-                                  min_port, max_port)
     if console_port is None:
-        return
+        console_port = widget.get_int(None, "Console port", min_port,
+                                      min_port, max_port)
+        if console_port is None:
+            return
+    elif not min_port <= console_port <= max_port:
+        die("Console port must be between {} and {}".format(min_port, max_port))
+
+    # plan the new console ports
+    try:
+        used = used_ports(api, project_id, list(nodes.values()), set(sel_nodes))
+    except gns3api.GNS3ApiException as err:
+        die("Can't get used console ports: {}".format(err))
+    ports = plan_ports(nodes, sel_nodes, used, console_port, min_port, max_port)
+    if ports is None:
+        die("Not enough free console ports")
 
     # update console port of selected nodes
-    for node_id in sel_nodes:
-        if nodes[node_id]['node_type'] == 'ethernet_switch':
-            continue
-        try:
-            node = api.request('PUT',
-                               ('/v2/projects', project_id, "nodes", node_id),
-                               {"console": console_port})
-        except gns3api.GNS3ApiException as err:
-            if isinstance(err, gns3api.HTTPError) and err.args[0] == 409:
-                widget.info(None, "{}: {}"
-                            .format(nodes[node_id]['name'], err.args[1]))
-            else:
-                die("Can't update node information: {}".format(err))
-        else:
-            if node['console'] != console_port:
-                widget.info(None, "{}: Can't update console port, using {}"
-                            .format(nodes[node_id]['name'], node['console']))
-        console_port += 1
-        if console_port > max_port:
-            console_port = min_port
+    results = update_ports(
+        lambda: gns3api.GNS3Api(cntl_url, cntl_user, cntl_passwd),
+        project_id, nodes, ports, jobs)
+    report(nodes, results, headless)
+    if any(message for _, _, message in results):
+        sys.exit(1)
 
 try:
     set_console(sys.argv)
@@ -1,228 +1,708 @@
 #!/usr/local/bin/python3
 """
 export_template.py - Export Template as an Appliance
+
+usage: export_template [-a | -f pattern] [-o dir] [-p] [-r file] [-H]
+                       [-i dirs [-c file]] [-j num]
+                       version parameter-file [project-id [sel-item ...]]
+
+  -a, --all                 export all templates
+  -f pattern, --filter=pattern
+                            export the templates, whose name matches
+                            the (shell-style) pattern
+  -o dir, --output=dir      output directory of a bulk export,
+                            the appliances are named <template>.gns3a,
+                            or <template>-<n>.gns3a when names collide,
+                            an existing appliance keeps its file name
+  -p, --prune               bulk export: delete the appliances of the output
+                            directory, whose template doesn't exist anymore
+  -r file, --report=file    bulk export: write a JSON report of the added,
+                            changed and removed appliances, "-" is stdout
+  -H, --headless            bulk export: no dialogs, the summary and the
+                            errors are printed, needs --output
+  -i dirs, --images=dirs    local image directories, separated by ':'
+                            (';' on Windows),
+                            images unknown to the compute are searched
+                            there and their checksum is calculated
+  -c file, --cache=file     checksum cache of the local images
+                            (default ~/.cache/gns3-tools/image_md5.json)
+  -j num, --jobs=num        maximum number of concurrent exports
+                            and checksum calculations (default 8)
+
+Without -a or -f a single template is exported, its name
+and the appliance file are asked in a dialog.
+
+A bulk export only rewrites the appliances, whose content changed.
+With a report no summary dialog is shown. When no template matches,
+nothing is exported or pruned.
 """
 
 import os
 import sys
+import getopt
+import hashlib
 import json
 import re
+import threading
 from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from fnmatch import fnmatchcase
 import gns3api
-from qt_widgets import SimpleWidgets
+from api_helpers import ThreadConnections
+
+widget = None
 
-widget = SimpleWidgets()
+SUPPORTED_TYPES = ("docker", "dynamips", "iou", "qemu")
+NO_MD5SUM = "00000000000000000000000000000000"
+
+# local images: subdirectory of the image directory, by template type
+IMAGE_SUBDIRS = {"dynamips": "IOS", "iou": "IOU", "qemu": "QEMU"}
+DEFAULT_CACHE = os.path.join(os.environ.get("XDG_CACHE_HOME") or
+                             os.path.expanduser(os.path.join("~", ".cache")),
+                             "gns3-tools", "image_md5.json")
+HASH_CHUNK = 1 << 20
 
 def die(text):
     """ terminate program with error message """
-    widget.alert(None, text)
+    if widget:
+        widget.alert(None, text)
     sys.exit(text)
 
+class ImageLists:
+    """
+    image lists of the computes
 
-# get command line parameter
-if len(sys.argv) < 3:
-    die("usage: export_template version parameter-file [project-id [sel-item ...]]")
-try:
-    with open(sys.argv[2], "r") as file:
-        cntl_url, cntl_user, cntl_passwd, *_ = file.read(512).splitlines()
-    if sys.argv[2].endswith(".tmp"):
-        os.remove(sys.argv[2])
-except (OSError, ValueError) as err:
-    die("Can't get controller connection params: {}".format(err))
-version = sys.argv[1]
-
-# check version
-ver_match = re.match(r'[vV]?(\d+)\.(\d+)', version)
-if ver_match:
-    ver_tuple = tuple(map(int, ver_match.groups()))
-if not ver_match or ver_tuple < (2, 2):
-    die("Unsupported version {}, need at least 2.2".format(version))
-
-# connect to GNS3 controller
-try:
-    api = gns3api.GNS3Api(cntl_url, cntl_user, cntl_passwd)
-except gns3api.GNS3ApiException as err:
-    die("Can't connect to GNS3 controller: {}".format(err))
+    Each list is fetched once per compute and template type
+    and indexed by the filename.
+    """
 
-template_name = widget.get_text(None, "Template name:")
-if not template_name:
-    sys.exit(0)
+    def __init__(self, connect):
+        self._conns = ThreadConnections(connect)
+        self._lock = threading.Lock()
+        self._lists = {}	# (compute_id, template_type) -> [lock, index]
 
-template = None
-try:
-    for template in api.request("GET", "/v2/templates"):
-        if template["name"] == template_name:
-            break
+    def get(self, compute_id, template_type):
+        """ return the image index, filename -> image info """
+        with self._lock:
+            entry = self._lists.setdefault((compute_id, template_type),
+                                           [threading.Lock(), None])
+        with entry[0]:
+            if entry[1] is None:
+                image_list = self._conns.request(
+                    "GET", ("/v2/computes", compute_id,
+                            template_type, "images"))
+                entry[1] = {image_info["filename"]: image_info
+                            for image_info in image_list}
+            return entry[1]
+
+def md5sum(path):
+    """ md5 checksum of a file, read in chunks """
+    md5 = hashlib.md5()
+    buffer = bytearray(HASH_CHUNK)
+    view = memoryview(buffer)
+    with open(path, "rb", buffering=0) as file:
+        while True:
+            size = file.readinto(buffer)
+            if not size:
+                break
+            md5.update(view[:size])
+    return md5.hexdigest()
+
+class LocalImages:
+    """
+    local image files and their checksums
+
+    The checksums are cached in a file, keyed by
+    the path, size and modification time of the image.
+    """
+
+    def __init__(self, image_dirs, cache_file):
+        self.image_dirs = image_dirs
+        self.cache_file = cache_file
+        try:
+            with open(cache_file, "r") as file:
+                self.cache = json.load(file)	# path -> [size, mtime, md5]
+        except (OSError, ValueError):
+            self.cache = {}
+        self.changed = False
+
+    def find(self, template_type, filename):
+        """ search an image in the image directories, returns its path """
+        for image_dir in self.image_dirs:
+            for path in (os.path.join(image_dir, IMAGE_SUBDIRS[template_type],
+                                      filename),
+                         os.path.join(image_dir, filename)):
+                if os.path.isfile(path):
+                    return os.path.realpath(path)
+        return None
+
+    def checksum(self, path):
+        """ returns size and md5 checksum of an image, None if unreadable """
+        try:
+            stat = os.stat(path)
+            entry = self.cache.get(path)
+            if entry and entry[:2] == [stat.st_size, stat.st_mtime_ns]:
+                return (stat.st_size, entry[2])
+            checksum = md5sum(path)
+        except OSError:
+            return None
+        self.cache[path] = [stat.st_size, stat.st_mtime_ns, checksum]
+        self.changed = True
+        return (stat.st_size, checksum)
+
+    def fill(self, appliances, jobs):
+        """
+        set size and checksum of the appliance images,
+        that are unknown to the compute
+
+        The images are hashed concurrently.
+        Returns the filenames of the images, that were not found.
+        """
+        unknown = {}	# path -> list of image entries
+        not_found = []
+        for gns3a in appliances:
+            template_type = next((key for key in IMAGE_SUBDIRS if key in gns3a),
+                                 None)
+            for image in gns3a.get("images", ()):
+                if image["md5sum"] != NO_MD5SUM:
+                    continue
+                path = self.find(template_type, image["filename"])
+                if path:
+                    unknown.setdefault(path, []).append(image)
+                else:
+                    not_found.append(image["filename"])
+
+        with ThreadPoolExecutor(max_workers=jobs) as executor:
+            for path, result in zip(unknown, executor.map(self.checksum, unknown)):
+                if result is None:
+                    not_found.append(os.path.basename(path))
+                    continue
+                for image in unknown[path]:
+                    image["filesize"], image["md5sum"] = result
+        return not_found
+
+    def save(self):
+        """ save the checksum cache, if changed """
+        if not self.changed:
+            return
+        os.makedirs(os.path.dirname(self.cache_file) or ".", exist_ok=True)
+        tmp_file = self.cache_file + ".tmp"
+        with open(tmp_file, "w") as file:
+            json.dump(self.cache, file, separators=(',', ':'))
+        os.replace(tmp_file, self.cache_file)
+        self.changed = False
+
+def appliance_filenames(templates, existing=None, digests=None):
+    """
+    unique file names of the appliances of templates
+
+    Characters not allowed in file names are replaced by '_'.
+    When names collide, ignoring case, the templates get a suffix
+    -2, -3, ... The names stay stable between exports: a template
+    keeps an existing file of the same appliance name, preferably
+    the one with the same content. existing maps the file names of
+    the directory to (appliance name, sha256 digest), digests the
+    template IDs to the digest of their new appliance.
+    Returns a dict template_id -> file name.
+    """
+    existing = existing or {}
+    digests = digests or {}
+    templates = sorted(templates, key=lambda t: (t["name"], t["template_id"]))
+    filenames = {}
+    used = {filename.lower() for filename in existing}
+
+    # existing files, same content first
+    candidates = {}
+    for filename in sorted(existing):
+        name, digest = existing[filename]
+        base = re.sub(r'[\x00-\x1f/\\:*?"<>|]', "_", name)
+        if re.fullmatch(re.escape(base) + r'(-\d+)?\.gns3a', filename, re.I):
+            candidates.setdefault(name, []).append((filename, digest))
+    for same_content in (True, False):
+        for template in templates:
+            files = candidates.get(template["name"])
+            if template["template_id"] in filenames or not files:
+                continue
+            for filename, digest in files:
+                if not same_content or \
+                   digest == digests.get(template["template_id"]):
+                    filenames[template["template_id"]] = filename
+                    files.remove((filename, digest))
+                    break
+
+    # new files
+    for template in templates:
+        if template["template_id"] in filenames:
+            continue
+        base = re.sub(r'[\x00-\x1f/\\:*?"<>|]', "_", template["name"])
+        filename = base + ".gns3a"
+        count = 1
+        while filename.lower() in used:
+            count += 1
+            filename = "{}-{}.gns3a".format(base, count)
+        used.add(filename.lower())
+        filenames[template["template_id"]] = filename
+    return filenames
+
+def template_to_appliance(template, image_lists):
+    """ convert a template into an appliance """
+    if template["template_type"] not in SUPPORTED_TYPES:
+        raise ValueError("Unsupported VM type '{}', must be docker, dynamips, "
+                         "iou or qemu.".format(template["template_type"]))
+
+    # basic information
+    gns3a = OrderedDict()
+    gns3a["name"]             = template["name"]
+    if template["category"] == "switch":
+        gns3a["category"]     = "multilayer_switch"
     else:
-        die("Template '{}' not found".format(template_name))
-except gns3api.GNS3ApiException as err:
-    die("Can't get templates: {}".format(err))
-
-if template["template_type"] not in ("docker", "dynamips", "iou", "qemu"):
-    die("Unsupported VM type '{}', must be docker, dynamips, iou or qemu."
-        .format(template["template_type"]))
-
-# basic information
-gns3a = OrderedDict()
-gns3a["name"]             = template["name"]
-if template["category"] == "switch":
-    gns3a["category"]     = "multilayer_switch"
-else:
-    gns3a["category"]     = template["category"]
-gns3a["description"]      = "Export of template '{}'".format(template["name"])
-gns3a["vendor_name"]      = "unknown"
-gns3a["vendor_url"]       = "http://www.example.com"
-gns3a["product_name"]     = template["name"]
-gns3a["registry_version"] = 3
-gns3a["status"]           = "experimental"
-gns3a["maintainer"]       = "Unknown"
-gns3a["maintainer_email"] = "unknown@example.org"
-for key in ("usage", "symbol", "first_port_name", "port_name_format"):
-    if template.get(key):
-        gns3a[key] = template[key]
-if not template.get("linked_clone", True):
-    gns3a["linked_clone"] = False
-    gns3a["registry_version"] = 4
-
-vm_images = OrderedDict()
-
-# Docker
-if template["template_type"] == "docker":
-    docker = OrderedDict()
-    gns3a["docker"] = docker
-    docker["adapters"] = template.get("adapters", 1)
-    for key in ("image", "start_command", "environment",
-                "console_type", "console_http_port", "console_http_path"):
-        if template.get(key):
-            docker[key] = template[key]
-    if docker["image"].endswith(":latest"):
-        docker["image"] = docker["image"][:-7]
-    if docker.get("console_type") not in ("http", "https"):
-        docker.pop("console_http_port", None)
-        docker.pop("console_http_path", None)
-
-# Dynamips
-elif template["template_type"] == "dynamips":
-    dynamips = OrderedDict()
-    gns3a["dynamips"] = dynamips
-    for key in ("chassis", "platform", "ram", "nvram", "startup_config",
-                "wic0", "wic1", "wic2", "slot0", "slot1", "slot2", "slot3",
-                "slot4", "slot5", "slot6", "midplane", "npe"):
+        gns3a["category"]     = template["category"]
+    gns3a["description"]      = "Export of template '{}'".format(template["name"])
+    gns3a["vendor_name"]      = "unknown"
+    gns3a["vendor_url"]       = "http://www.example.com"
+    gns3a["product_name"]     = template["name"]
+    gns3a["registry_version"] = 3
+    gns3a["status"]           = "experimental"
+    gns3a["maintainer"]       = "Unknown"
+    gns3a["maintainer_email"] = "unknown@example.org"
+    for key in ("usage", "symbol", "first_port_name", "port_name_format"):
         if template.get(key):
-            dynamips[key] = template[key]
-    vm_images["image"] = template["image"]
-
-# IOU VM
-elif template["template_type"] == "iou":
-    iou = OrderedDict()
-    gns3a["iou"] = iou
-    for key in ("ethernet_adapters", "serial_adapters",
-                "nvram", "ram", "startup_config"):
-        iou[key] = template[key]
-    vm_images["image"] = template["path"]
-
-# QEMU
-elif template["template_type"] == "qemu":
-    qemu = OrderedDict()
-    gns3a["qemu"] = qemu
-    qemu["adapter_type"] = template.get("adapter_type", "e1000")
-    qemu["adapters"] = template.get("adapters", 1)
-    if template.get("custom_adapters"):
-        qemu["custom_adapters"] = template["custom_adapters"]
-        gns3a["registry_version"] = max(gns3a["registry_version"], 6)
-    qemu["ram"] = template.get("ram", 256)
-    if template.get("cpus", 1) >= 2:
-        qemu["cpus"] = template["cpus"]
-        gns3a["registry_version"] = max(gns3a["registry_version"], 4)
-    for key in ("kernel_image", "initrd", "bios_image"):
-        if template.get(key):
-            vm_images[key] = template[key]
-    if "bios_image" in vm_images:
-        gns3a["registry_version"] = max(gns3a["registry_version"], 4)
-    for key in ("hda", "hdb", "hdc", "hdd"):
-        hd_image = key + "_disk_image"
-        hd_intf = key + "_disk_interface"
-        if template.get(hd_image):
-            vm_images[hd_image] = template[hd_image]
-            qemu[hd_intf] = template.get(hd_intf, "ide")
-            if qemu[hd_intf] == "sata":
-                gns3a["registry_version"] = max(gns3a["registry_version"], 4)
-    if template.get("cdrom_image"):
-        vm_images["cdrom_image"] = template["cdrom_image"]
-    match = re.search(r'qemu-system-([^/\\]*)$', template["qemu_path"])
-    if match:
-        qemu["arch"] = match.group(1)
-    else:
-        qemu["arch"] = "i386"
-    qemu["console_type"] = template.get("console_type", "telnet")
-    if qemu["console_type"] == "spice":
-        gns3a["registry_version"] = max(gns3a["registry_version"], 5)
-    if template.get("boot_priority") and template["boot_priority"] != "c":
-        qemu["boot_priority"] = template["boot_priority"]
-    if template.get("kernel_command_line"):
-        qemu["kernel_command_line"] = template["kernel_command_line"]
-    qemu["kvm"] = "allow"
-    options = template.get("options")
-    if options:
-        options, changes = re.subn(r'\s*-no-kvm\b', "", options)
-        if changes:
-            qemu["kvm"] = "disable"
-        options = re.sub(r'\s*-nographic\b', "", options)
-        options = options.strip()
-    if options:
-        qemu["options"] = options
-    if template.get("cpu_throttling"):
-        qemu["cpu_throttling"] = template["cpu_throttling"]
-    if template.get("process_priority") and \
-       template["process_priority"] != "normal":
-        qemu["process_priority"] = template["process_priority"]
-
-# Images
-image_version = "0.0"
-if vm_images:
+            gns3a[key] = template[key]
+    if not template.get("linked_clone", True):
+        gns3a["linked_clone"] = False
+        gns3a["registry_version"] = 4
+
+    vm_images = OrderedDict()
+
+    # Docker
+    if template["template_type"] == "docker":
+        docker = OrderedDict()
+        gns3a["docker"] = docker
+        docker["adapters"] = template.get("adapters", 1)
+        for key in ("image", "start_command", "environment",
+                    "console_type", "console_http_port", "console_http_path"):
+            if template.get(key):
+                docker[key] = template[key]
+        if docker["image"].endswith(":latest"):
+            docker["image"] = docker["image"][:-7]
+        if docker.get("console_type") not in ("http", "https"):
+            docker.pop("console_http_port", None)
+            docker.pop("console_http_path", None)
+
+    # Dynamips
+    elif template["template_type"] == "dynamips":
+        dynamips = OrderedDict()
+        gns3a["dynamips"] = dynamips
+        for key in ("chassis", "platform", "ram", "nvram", "startup_config",
+                    "wic0", "wic1", "wic2", "slot0", "slot1", "slot2", "slot3",
+                    "slot4", "slot5", "slot6", "midplane", "npe"):
+            if template.get(key):
+                dynamips[key] = template[key]
+        vm_images["image"] = template["image"]
+
+    # IOU VM
+    elif template["template_type"] == "iou":
+        iou = OrderedDict()
+        gns3a["iou"] = iou
+        for key in ("ethernet_adapters", "serial_adapters",
+                    "nvram", "ram", "startup_config"):
+            iou[key] = template[key]
+        vm_images["image"] = template["path"]
+
+    # QEMU
+    elif template["template_type"] == "qemu":
+        qemu = OrderedDict()
+        gns3a["qemu"] = qemu
+        qemu["adapter_type"] = template.get("adapter_type", "e1000")
+        qemu["adapters"] = template.get("adapters", 1)
+        if template.get("custom_adapters"):
+            qemu["custom_adapters"] = template["custom_adapters"]
+            gns3a["registry_version"] = max(gns3a["registry_version"], 6)
+        qemu["ram"] = template.get("ram", 256)
+        if template.get("cpus", 1) >= 2:
+            qemu["cpus"] = template["cpus"]
+            gns3a["registry_version"] = max(gns3a["registry_version"], 4)
+        for key in ("kernel_image", "initrd", "bios_image"):
+            if template.get(key):
+                vm_images[key] = template[key]
+        if "bios_image" in vm_images:
+            gns3a["registry_version"] = max(gns3a["registry_version"], 4)
+        for key in ("hda", "hdb", "hdc", "hdd"):
+            hd_image = key + "_disk_image"
+            hd_intf = key + "_disk_interface"
+            if template.get(hd_image):
+                vm_images[hd_image] = template[hd_image]
+                qemu[hd_intf] = template.get(hd_intf, "ide")
+                if qemu[hd_intf] == "sata":
+                    gns3a["registry_version"] = max(gns3a["registry_version"], 4)
+        if template.get("cdrom_image"):
+            vm_images["cdrom_image"] = template["cdrom_image"]
+        match = re.search(r'qemu-system-([^/\\]*)$', template["qemu_path"])
+        if match:
+            qemu["arch"] = match.group(1)
+        else:
+            qemu["arch"] = "i386"
+        qemu["console_type"] = template.get("console_type", "telnet")
+        if qemu["console_type"] == "spice":
+            gns3a["registry_version"] = max(gns3a["registry_version"], 5)
+        if template.get("boot_priority") and template["boot_priority"] != "c":
+            qemu["boot_priority"] = template["boot_priority"]
+        if template.get("kernel_command_line"):
+            qemu["kernel_command_line"] = template["kernel_command_line"]
+        qemu["kvm"] = "allow"
+        options = template.get("options")
+        if options:
+            options, changes = re.subn(r'\s*-no-kvm\b', "", options)
+            if changes:
+                qemu["kvm"] = "disable"
+            options = re.sub(r'\s*-nographic\b', "", options)
+            options = options.strip()
+        if options:
+            qemu["options"] = options
+        if template.get("cpu_throttling"):
+            qemu["cpu_throttling"] = template["cpu_throttling"]
+        if template.get("process_priority") and \
+           template["process_priority"] != "normal":
+            qemu["process_priority"] = template["process_priority"]
+
+    # Images
+    image_version = "0.0"
+    if vm_images:
+        image_index = image_lists.get(template["compute_id"],
+                                      template["template_type"])
+        images = []
+        version_images = OrderedDict()
+        for image_type, path in vm_images.items():
+            filename = re.split(r'[/\\]', path)[-1]
+            image_info = image_index.get(filename, {})
+            image = OrderedDict()
+            image["filename"] = filename
+            image["version"] = image_version
+            image["md5sum"] = image_info.get("md5sum", NO_MD5SUM)
+            image["filesize"] = image_info.get("filesize", 0)
+            images.append(image)
+            version_images[image_type] = filename
+        gns3a["images"] = images
+        version_ver = OrderedDict()
+        version_ver["name"] = image_version
+        if template.get("idlepc"):
+            version_ver["idlepc"] = template["idlepc"]
+        version_ver["images"] = version_images
+        gns3a["versions"] = [version_ver]
+
+    return gns3a
+
+def appliance_data(gns3a):
+    """ canonical serialization of an appliance """
+    return (json.dumps(gns3a, indent=4, separators=(",", ": ")) + "\n") \
+        .encode("utf-8")
+
+def file_digest(filename):
+    """ sha256 digest of a file, None if it doesn't exist """
     try:
-        image_list = api.request("GET", ("/v2/computes",
-                                         template["compute_id"],
-                                         template["template_type"],
-                                         "images"))
+        with open(filename, "rb") as file:
+            return hashlib.sha256(file.read()).hexdigest()
+    except FileNotFoundError:
+        return None
+
+def save_appliance(filename, gns3a):
+    """ save appliance """
+    with open(filename, "wb") as f_out:
+        f_out.write(appliance_data(gns3a))
+
+def update_appliance(filename, gns3a):
+    """
+    save appliance, if its content differs from the existing file
+
+    Returns the state ("added", "changed" or "unchanged")
+    and the sha256 digest of the appliance.
+    """
+    data = appliance_data(gns3a)
+    digest = hashlib.sha256(data).hexdigest()
+    old_digest = file_digest(filename)
+    if old_digest == digest:
+        return ("unchanged", digest)
+    with open(filename, "wb") as f_out:
+        f_out.write(data)
+    return ("added" if old_digest is None else "changed", digest)
+
+def existing_appliances(directory):
+    """
+    get the appliances of a directory
+
+    Returns a dict file name -> (appliance name, sha256 digest),
+    files that are not readable appliances are ignored.
+    """
+    existing = {}
+    for filename in os.listdir(directory):
+        if not filename.endswith(".gns3a"):
+            continue
+        try:
+            with open(os.path.join(directory, filename), "rb") as file:
+                data = file.read()
+            name = json.loads(data.decode("utf-8"))["name"]
+        except (OSError, ValueError, KeyError, TypeError):
+            continue
+        if isinstance(name, str):
+            existing[filename] = (name, hashlib.sha256(data).hexdigest())
+    return existing
+
+def removed_appliances(existing, exported, pattern=None):
+    """
+    find the existing appliances without an exported template
+
+    Only appliances, whose name matches the pattern, are considered.
+    Returns a list of (appliance name, filename).
+    """
+    removed = []
+    for filename in sorted(existing):
+        name = existing[filename][0]
+        if filename in exported:
+            continue
+        if pattern is None or fnmatchcase(name, pattern):
+            removed.append((name, filename))
+    return removed
+
+def save_cache(local_images):
+    """ save the checksum cache, a failure is only reported """
+    try:
+        local_images.save()
+    except OSError as err:
+        sys.stderr.write("Can't save checksum cache: {}\n".format(err))
+
+def export_templates(templates, image_lists, local_images, directory,
+                     existing, jobs):
+    """
+    export templates into a directory, the conversions run concurrently
+
+    existing are the appliances of the directory, see existing_appliances.
+    Only the appliances, that differ from the files in the directory,
+    are written.
+
+    Returns a list of (template name, error) of the failed exports,
+    the filenames of the local images, that were not found, the
+    changes, a dict of the added, changed and unchanged appliances,
+    and the file names, a dict template_id -> file name.
+    """
+    def convert(template):
+        try:
+            return (template, template_to_appliance(template, image_lists), None)
+        except (gns3api.GNS3ApiException, ValueError) as err:
+            return (template, None, err)
+        except KeyError as err:
+            return (template, None,
+                    ValueError("missing field '{}'".format(err.args[0])))
+
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        results = list(executor.map(convert, templates))
+    errors = [(template["name"], err) for template, _, err in results if err]
+    results = [(template, gns3a) for template, gns3a, err in results if not err]
+
+    not_found = []
+    if local_images:
+        not_found = local_images.fill([gns3a for _, gns3a in results], jobs)
+
+    digests = {template["template_id"]:
+               hashlib.sha256(appliance_data(gns3a)).hexdigest()
+               for template, gns3a in results}
+    filenames = appliance_filenames(templates, existing, digests)
+    changes = {"added": [], "changed": [], "unchanged": []}
+    for template, gns3a in results:
+        filename = filenames[template["template_id"]]
+        try:
+            state, digest = update_appliance(os.path.join(directory, filename),
+                                             gns3a)
+        except OSError as err:
+            errors.append((template["name"], err))
+            continue
+        changes[state].append({"name": template["name"], "file": filename,
+                               "sha256": digest})
+    return (errors, not_found, changes, filenames)
+
+def export_template(argv):
+    """ parse command line, convert template(s) and save appliance(s) """
+    global widget			# pylint: disable=global-statement
+
+    # get arguments
+    usage = "usage:\nexport_template [-a | -f pattern] [-o dir] [-p] [-r file] [-H] " \
+            "[-i dirs [-c file]] [-j num] " \
+            "version parameter-file [project-id [sel-item ...]]"
+    try:
+        opts, args = getopt.getopt(argv[1:], "af:o:pr:Hi:c:j:",
+                                   ["all", "filter=", "output=", "prune",
+                                    "report=", "headless", "images=",
+                                    "cache=", "jobs="])
+        opts = dict(opts)
+        jobs = int(opts.get('-j', opts.get('--jobs', 8)))
+    except (getopt.GetoptError, ValueError) as err:
+        die("{}\n{}".format(err, usage))
+    export_all = '-a' in opts or '--all' in opts
+    pattern = opts.get('-f', opts.get('--filter'))
+    directory = opts.get('-o', opts.get('--output'))
+    prune = '-p' in opts or '--prune' in opts
+    report_file = opts.get('-r', opts.get('--report'))
+    image_dirs = opts.get('-i', opts.get('--images'))
+    cache_file = opts.get('-c', opts.get('--cache', DEFAULT_CACHE))
+    headless = '-H' in opts or '--headless' in opts
+    if headless and not ((export_all or pattern) and directory):
+        sys.exit("Headless mode needs --output and --all or --filter\n" + usage)
+    if not headless:
+        from qt_widgets import SimpleWidgets
+        widget = SimpleWidgets()
+    argv = argv[:1] + args
+    if len(argv) < 3 or jobs < 1 or (export_all and pattern) or \
+       ((prune or report_file) and not (export_all or pattern)):
+        die(usage)
+    try:
+        with open(argv[2], "r") as file:
+            cntl_url, cntl_user, cntl_passwd, *_ = file.read(512).splitlines()
+        if argv[2].endswith(".tmp"):
+            os.remove(argv[2])
+    except (OSError, ValueError) as err:
+        die("Can't get controller connection params: {}".format(err))
+    version = argv[1]
+
+    # check version
+    ver_match = re.match(r'[vV]?(\d+)\.(\d+)', version)
+    if ver_match:
+        ver_tuple = tuple(map(int, ver_match.groups()))
+    if not ver_match or ver_tuple < (2, 2):
+        die("Unsupported version {}, need at least 2.2".format(version))
+
+    def connect():
+        return gns3api.GNS3Api(cntl_url, cntl_user, cntl_passwd)
+
+    # connect to GNS3 controller
+    try:
+        api = connect()
     except gns3api.GNS3ApiException as err:
-        die("Can't get image list: {}".format(err))
-
-    images = []
-    version_images = OrderedDict()
-    for image_type, path in vm_images.items():
-        filename = re.split(r'[/\\]', path)[-1]
-        filesize = 0
-        md5sum = "00000000000000000000000000000000"
-        for image_info in image_list:
-            if image_info["filename"] == filename:
-                filesize = image_info["filesize"]
-                md5sum = image_info["md5sum"]
-                break
-        image = OrderedDict()
-        image["filename"] = filename
-        image["version"] = image_version
-        image["md5sum"] = md5sum
-        image["filesize"] = filesize
-        images.append(image)
-        version_images[image_type] = filename
-    gns3a["images"] = images
-    version_ver = OrderedDict()
-    version_ver["name"] = image_version
-    if template.get("idlepc"):
-        version_ver["idlepc"] = template["idlepc"]
-    version_ver["images"] = version_images
-    gns3a["versions"] = [version_ver]
-
-# save appliance
-ofile = widget.get_save_filename("Save appliance", "~",
-                                 (("GNS3 Appliance", "*.gns3a *.gns3appliance"),
-                                  ("all files", "*")))
-if not ofile:
-    sys.exit(0)
+        die("Can't connect to GNS3 controller: {}".format(err))
+    image_lists = ImageLists(connect)
+    local_images = None
+    if image_dirs:
+        local_images = LocalImages([os.path.expanduser(image_dir) for image_dir
+                                    in image_dirs.split(os.pathsep) if image_dir],
+                                   os.path.expanduser(cache_file))
+
+    if not export_all and not pattern:
+        # single template
+        template_name = widget.get_text(None, "Template name:")
+        if not template_name:
+            sys.exit(0)
+
+        try:
+            for template in api.request("GET", "/v2/templates"):
+                if template["name"] == template_name:
+                    break
+            else:
+                die("Template '{}' not found".format(template_name))
+            gns3a = template_to_appliance(template, image_lists)
+        except gns3api.GNS3ApiException as err:
+            die("Can't get templates/images: {}".format(err))
+        except ValueError as err:
+            die(str(err))
+        except KeyError as err:
+            die("Template '{}': missing field '{}'".format(template_name,
+                                                           err.args[0]))
+        not_found = []
+        if local_images:
+            not_found = local_images.fill([gns3a], jobs)
+            save_cache(local_images)
+
+        # save appliance
+        ofile = widget.get_save_filename("Save appliance", "~",
+                                         (("GNS3 Appliance", "*.gns3a *.gns3appliance"),
+                                          ("all files", "*")))
+        if not ofile:
+            sys.exit(0)
+        try:
+            save_appliance(ofile, gns3a)
+        except OSError as err:
+            die("Can't save appliance: {}".format(err))
+        if not_found:
+            widget.info(None, "Local images not found:\n" + "\n".join(not_found))
+        return
+
+    # bulk export
+    if not directory:
+        directory = widget.get_text(None, "Output directory:", "~")
+        if not directory:
+            sys.exit(0)
+    directory = os.path.expanduser(directory)
+    try:
+        os.makedirs(directory, exist_ok=True)
+    except OSError as err:
+        die("Can't create output directory: {}".format(err))
+    try:
+        templates = [template for template in api.request("GET", "/v2/templates")
+                     if template["template_type"] in SUPPORTED_TYPES and
+                     (export_all or fnmatchcase(template["name"], pattern))]
+    except gns3api.GNS3ApiException as err:
+        die("Can't get templates: {}".format(err))
+    if not templates:
+        die("No template to export")
+
+    try:
+        existing = existing_appliances(directory)
+    except OSError as err:
+        die("Can't read output directory: {}".format(err))
+    errors, not_found, changes, filenames = export_templates(
+        templates, image_lists, local_images, directory, existing, jobs)
+    if local_images:
+        save_cache(local_images)
+
+    # appliances without template, not pruned when every export failed
+    prune = prune and len(errors) < len(templates)
+    try:
+        removed = removed_appliances(existing, set(filenames.values()),
+                                     None if export_all else pattern)
+        if prune:
+            for _, filename in removed:
+                os.remove(os.path.join(directory, filename))
+    except OSError as err:
+        die("Can't check/prune output directory: {}".format(err))
+
+    if report_file:
+        report = OrderedDict()
+        report["directory"] = directory
+        for state in ("added", "changed", "unchanged"):
+            report[state] = changes[state]
+        report["removed"] = [{"name": name, "file": filename}
+                             for name, filename in removed]
+        report["pruned"] = prune
+        report["failed"] = [{"name": name, "error": str(err)}
+                            for name, err in errors]
+        report["images_not_found"] = sorted(set(not_found))
+        try:
+            if report_file == "-":
+                json.dump(report, sys.stdout, indent=4)
+                sys.stdout.write("\n")
+            else:
+                with open(report_file, "w") as file:
+                    json.dump(report, file, indent=4)
+                    file.write("\n")
+        except OSError as err:
+            die("Can't write report: {}".format(err))
+
+    text = "{} of {} templates exported to {}\n" \
+           "{} added, {} changed, {} unchanged, {} {}".format(
+               len(templates) - len(errors), len(templates), directory,
+               len(changes["added"]), len(changes["changed"]),
+               len(changes["unchanged"]), len(removed),
+               "pruned" if prune else "without template")
+    if not_found:
+        text += "\n\nLocal images not found:\n" + "\n".join(sorted(set(not_found)))
+    if errors:
+        text += "\n\nFailed:\n" + "\n".join("{}: {}".format(name, err)
+                                           for name, err in errors)
+        die(text)
+    if headless:
+        if report_file != "-":
+            print(text)
+    elif not report_file:
+        widget.info(None, text)
+
 try:
-    with open(ofile, "w") as f_out:
-        json.dump(gns3a, f_out, indent=4, separators=(",", ": "))
-        f_out.write("\n")
-except OSError as err:
-    die("Can't save appliance: {}".format(err))
+    export_template(sys.argv)
+except KeyboardInterrupt:
+    sys.stderr.write("Aborted\n")
@@ -2,25 +2,118 @@
 
 """
 link_resume.py - resume links of all/selected nodes
+
+usage: link_resume [-j num] [-s file | -r file] version parameter-file project-id [sel-item ...]
+
+  -j num, --jobs=num        maximum number of concurrent requests (default 8)
+  -s file, --save=file      save the link state (suspend and filters) of
+                            the project into a snapshot file
+  -r file, --restore=file   restore the link state from a snapshot file,
+                            only links of the selected nodes, if any
+
+On restore only the links differing from the snapshot are updated,
+the snapshot must be from the same project.
+Links are matched by their link ID, recreated links by their endpoints.
 """
 
+import getopt
+import json
 import os
 import sys
+from concurrent.futures import ThreadPoolExecutor
 import gns3api
+from api_helpers import ThreadConnections
 from qt_widgets import SimpleWidgets
+from topology import Link, Topology
+
+# up to this number of selected nodes their links are queried node by node
+PER_NODE_LIMIT = 10
 
 def die(text):
     """ terminate program with error message """
     SimpleWidgets().alert(None, text)
     sys.exit(text)
 
+def update_links(connect, project_id, updates, jobs):
+    """
+    update the links concurrently, returns the first error
+
+    updates is a list of (link_id, data).
+    """
+    conns = ThreadConnections(connect)
+
+    def update(link_update):
+        link_id, data = link_update
+        try:
+            conns.request('PUT', ('/v2/projects', project_id, 'links', link_id),
+                          data)
+        except gns3api.GNS3ApiException as err:
+            return err
+        return None
+
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        errors = [err for err in executor.map(update, updates) if err]
+    return errors[0] if errors else None
+
+def save_snapshot(filename, project_id, topology):
+    """ save the link state into a snapshot file """
+    snapshot = {'project_id': project_id,
+                'links': [link.to_list() for link in topology.links.values()]}
+    with open(filename, "w") as file:
+        json.dump(snapshot, file, separators=(',', ':'))
+
+def load_snapshot(filename):
+    """ load a snapshot file """
+    with open(filename, "r") as file:
+        snapshot = json.load(file)
+    if not isinstance(snapshot, dict) or \
+       not isinstance(snapshot.get('links'), list):
+        raise ValueError("invalid snapshot format")
+    return snapshot
+
+def restore_updates(snapshot, topology, sel_nodes=None):
+    """
+    compare a snapshot with the current link state
+
+    Returns the updates (link_id, data) of the changed links and
+    the number of snapshot links, that don't exist anymore.
+    """
+    updates = []
+    missing = 0
+    for link in (Link.from_list(data) for data in snapshot['links']):
+        if sel_nodes and not any(node_id in sel_nodes
+                                 for node_id, _, _ in link.endpoints):
+            continue
+        current = topology.find(link)
+        if current is None:
+            missing += 1
+            continue
+        data = {}
+        if current.suspend != link.suspend:
+            data['suspend'] = link.suspend
+        if current.filters != link.filters:
+            data['filters'] = link.filters
+        if data:
+            updates.append((current.link_id, data))
+    return (updates, missing)
 
 def link_resume(argv):
     """ parse command line, retrieve nodes and resume connected links """
 
     # get arguments
-    if len(argv) < 4:
-        die("usage:\nlink_resume version parameter-file project-id [sel-item ...]")
+    usage = "usage:\nlink_resume [-j num] [-s file | -r file] " \
+            "version parameter-file project-id [sel-item ...]"
+    try:
+        opts, args = getopt.getopt(argv[1:], "j:s:r:", ["jobs=", "save=", "restore="])
+        opts = dict(opts)
+        jobs = int(opts.get('-j', opts.get('--jobs', 8)))
+    except (getopt.GetoptError, ValueError) as err:
+        die("{}\n{}".format(err, usage))
+    save_file = opts.get('-s', opts.get('--save'))
+    restore_file = opts.get('-r', opts.get('--restore'))
+    argv = argv[:1] + args
+    if len(argv) < 4 or jobs < 1 or (save_file and restore_file):
+        die(usage)
     try:
         with open(argv[2], "r") as file:
             cntl_url, cntl_user, cntl_passwd, *_ = file.read(512).splitlines()
@@ -31,33 +124,69 @@ def link_resume(argv):
     project_id = argv[3]
     sel_items = argv[4:]
 
+    def connect():
+        return gns3api.GNS3Api(cntl_url, cntl_user, cntl_passwd)
+
     # connect to GNS3 controller
     try:
-        api = gns3api.GNS3Api(cntl_url, cntl_user, cntl_passwd)
+        api = connect()
     except gns3api.GNS3ApiException as err:
         die("Can't connect to GNS3 controller: {}".format(err))
 
+    if save_file:
+        try:
+            save_snapshot(save_file, project_id, Topology.from_project(api, project_id))
+        except gns3api.GNS3ApiException as err:
+            die("Can't get link information: {}".format(err))
+        except OSError as err:
+            die("Can't save snapshot: {}".format(err))
+        return
+
+    if restore_file:
+        sel_nodes = frozenset(item[6:] for item in sel_items
+                              if item.startswith("nodes/"))
+        try:
+            snapshot = load_snapshot(restore_file)
+        except (OSError, ValueError) as err:
+            die("Can't read snapshot: {}".format(err))
+        if snapshot.get('project_id') != project_id:
+            die("Snapshot is from another project")
+        try:
+            updates, missing = restore_updates(
+                snapshot, Topology.from_project(api, project_id), sel_nodes)
+            err = update_links(connect, project_id, updates, jobs)
+            if err:
+                raise err
+        except gns3api.GNS3ApiException as err:
+            die("Can't get/set link information: {}".format(err))
+        except (OSError, ValueError, KeyError, TypeError) as err:
+            die("Can't read snapshot: {}".format(err))
+        if missing:
+            SimpleWidgets().info(None, "{} links restored, {} links of the "
+                                 "snapshot don't exist anymore"
+                                 .format(len(updates), missing))
+        return
+
     try:
         if not sel_items:
             # resume all links
-            for link in api.request('GET', ('/v2/projects', project_id, 'links')):
-                if link['suspend']:
-                    api.request('PUT', ('/v2/projects', project_id, 'links', link['link_id']),
-                                {'suspend': False})
+            links = Topology.from_project(api, project_id).links.values()
         else:
             # resume links of selected nodes
             sel_nodes = frozenset(item[6:] for item in sel_items
                                   if item.startswith("nodes/"))
             if not sel_nodes:
                 die("No node selected")
-            for link in api.request('GET', ('/v2/projects', project_id, 'links')):
-                if not link['suspend']:
-                    continue
-                for node in link['nodes']:
-                    if node['node_id'] in sel_nodes:
-                        api.request('PUT', ('/v2/projects', project_id, 'links', link['link_id']),
-                                    {'suspend': False})
-                        break
+            if len(sel_nodes) <= PER_NODE_LIMIT:
+                topology = Topology.from_nodes(connect, project_id, sel_nodes, jobs)
+            else:
+                topology = Topology.from_project(api, project_id)
+            links = topology.links_of(sel_nodes)
+        err = update_links(connect, project_id,
+                           [(link.link_id, {'suspend': False})
+                            for link in links if link.suspend], jobs)
+        if err:
+            raise err
     except gns3api.GNS3ApiException as err:
         die("Can't get/set link information: {}".format(err))
 
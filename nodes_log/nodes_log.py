@@ -2,35 +2,569 @@
 
 """
 nodes_log - get log of nodes
+
+usage: nodes_log [-j num] [-t num] [-m num] [-f [-i sec] [-s file]] [-a dir]
+                 version parameter-file project-id [sel-item ...]
+       nodes_log -g pattern bundle|dir
+
+  -j num, --jobs=num        maximum number of concurrent requests (default 8)
+  -t num, --tail=num        output only the last num lines of each log file
+  -m num, --max-bytes=num   output only the last num bytes of each log file
+  -f, --follow              output appended data as the log files grow
+  -i sec, --interval=sec    poll interval of --follow (default 2)
+  -s file, --state=file     file with the offsets already read by --follow
+                            (default ~/.nodes_log_state.json)
+  -a dir, --archive=dir     write the log files into a new bundle in dir
+  -g regex, --grep=regex    search the log files of a bundle, when a
+                            directory is given its latest bundle
+
+The log of a node is written as soon as it's retrieved.
+
+--follow remembers the offsets already read in the state file and
+continues from there in the next run. New data is retrieved by range
+requests, when the controller doesn't support them, the data up to
+the offset is skipped. An incomplete last line is output, when it's
+completed. On Ctrl-C the offsets are saved, too.
+
+A bundle is a ZIP file named nodes_log-<date>-<time>.zip, a counter
+is appended when this name already exists. It contains a manifest and
+for each log file a compressed object and an index of its trigrams.
+--grep decompresses only the log files, whose index contains the
+literal parts of the pattern. Log files, that are unchanged since the
+previous bundle, are not stored again, the manifest refers to the
+bundle containing them, as long as that bundle exists.
 """
 
+import codecs
+import collections
+import getopt
+import hashlib
+import http.client
+import io
+import json
 import os
+import re
+import shutil
 import sys
+import tempfile
+import time
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
 import gns3api
+from api_helpers import StreamClient
+
+CHUNK_SIZE = 65536		# read size of log files
+SPOOL_SIZE = 1024 * 1024	# log size kept in memory, before using a file
+
+class RingBuffer:
+    """ keeps the last bytes of a stream, at most max_bytes """
+
+    def __init__(self, max_bytes):
+        self._max_bytes = max_bytes
+        self._data = bytearray()
+
+    def write(self, data):
+        """ add data """
+        self._data += data
+        if len(self._data) > self._max_bytes:
+            del self._data[:len(self._data) - self._max_bytes]
+
+    def getvalue(self):
+        """ return the kept data """
+        return bytes(self._data)
+
+class Section:
+    """
+    writes the section of a log file
+
+    The text is decoded incrementally, trailing newlines are removed.
+    With tail only the last lines are kept.
+    """
+
+    def __init__(self, out, fname, tail=None):
+        self._out = out
+        self._fname = fname
+        self._decoder = codecs.getincrementaldecoder('utf-8')(errors='ignore')
+        self._newlines = 0		# held back trailing newlines
+        self._empty = True
+        self._lines = None
+        self._partial = ""
+        if tail is not None:
+            self._lines = collections.deque(maxlen=tail)
 
-def node_file(api, node, fname):
-    """ get file from a node """
-    data = None
+    def _write(self, text):
+        """ write text, trailing newlines are held back """
+        stripped = text.rstrip("\n")
+        if stripped:
+            if self._empty:
+                self._out.write(self._fname + ":\n")
+                self._empty = False
+            self._out.write("\n" * self._newlines + stripped)
+            self._newlines = 0
+        self._newlines += len(text) - len(stripped)
+
+    def write(self, data, final=False):
+        """ add data """
+        text = self._decoder.decode(data, final)
+        if self._lines is None:
+            self._write(text)
+            return
+        lines = (self._partial + text).split("\n")
+        self._partial = lines.pop()
+        self._lines.extend(lines)
+
+    def close(self):
+        """ end of the log file """
+        self.write(b"", final=True)
+        if self._lines is not None:
+            if self._partial:
+                self._lines.append(self._partial)
+            self._write("\n".join(self._lines))
+        if not self._empty:
+            self._out.write("\n\n")
+
+def log_files(node):
+    """ names of the log files of a node """
+    fnames = []
+    if node['node_type'] == 'docker':
+        fnames.append("vnc.log")
+    elif node['node_type'] == 'dynamips':
+        fnames.append("{}_i{}_log.txt".format(node['properties']['platform'],
+                                              node['properties']['dynamips_id']))
+    elif node['node_type'] == 'qemu':
+        fnames.append("qemu.log")
+        fnames.append("qemu-img.log")
+    elif node['node_type'] == 'vpcs':
+        fnames.append("vpcs.log")
+    fnames.append("ubridge.log")
+    return fnames
+
+def node_file(client, node, fname, tail=None, max_bytes=None, offset=0,
+              whole_lines=False):
+    """
+    get file from a node, starting at offset
+
+    Returns a spooled temporary file with the section of the log file
+    and the new offset. The data before offset is requested by a range
+    request, when the controller ignores it, the data is skipped.
+    With whole_lines an incomplete last line is held back, the new
+    offset points to its start.
+    """
+    out = tempfile.SpooledTemporaryFile(max_size=SPOOL_SIZE, mode='w+',
+                                        encoding='utf-8')
     try:
-        data = api.request("GET", ("/v2/projects", node['project_id'],
-                                   "nodes", node['node_id'], "files", fname))
-    except gns3api.GNS3ApiException as err:
-        if api.status_code != 404:
-            sys.exit("Can't get log file: {}".format(err))
+        headers = None
+        if offset:
+            headers = {'Range': 'bytes={}-'.format(offset)}
+        resp = client.get(("/v2/projects", node['project_id'], "nodes",
+                           node['node_id'], "files", fname), headers)
+        if resp.status == 404:
+            resp.read()
+            return (out, offset)
+        if resp.status == 416:		# range not satisfiable, no new data
+            resp.read()
+            size = (resp.getheader('Content-Range') or "").rpartition('/')[2]
+            if size.isdigit() and int(size) < offset:	# file truncated
+                out.close()
+                return node_file(client, node, fname, tail, max_bytes,
+                                 whole_lines=whole_lines)
+            return (out, offset)
+        if resp.status == 206:
+            skip = 0
+        elif resp.status == 200:
+            skip = offset
+        else:
+            sys.exit("Can't get log file: {} {}".format(resp.status, resp.reason))
+        section = Section(out, fname, tail)
+        ring = None
+        if max_bytes is not None:
+            ring = RingBuffer(max_bytes)
+        size = offset - skip
+        held = b""			# incomplete last line
+        while True:
+            data = resp.read(CHUNK_SIZE)
+            if not data:
+                break
+            size += len(data)
+            if skip:
+                dropped = min(skip, len(data))
+                data = data[dropped:]
+                skip -= dropped
+            if whole_lines:
+                data = held + data
+                end = data.rfind(b"\n") + 1
+                held = data[end:]
+                data = data[:end]
+            if ring:
+                ring.write(data)
+            else:
+                section.write(data)
+        if size < offset:		# file truncated, read it again
+            out.close()
+            return node_file(client, node, fname, tail, max_bytes,
+                             whole_lines=whole_lines)
+        if ring:
+            section.write(ring.getvalue())
+        section.close()
+    except (OSError, http.client.HTTPException,
+            gns3api.GNS3ApiException) as err:
+        sys.exit("Can't get log file: {}".format(err))
+    out.seek(0)
+    return (out, size - len(held))
 
-    if data:
-        data = fname + ":\n" + \
-               data.decode('utf-8', errors='ignore').rstrip("\n") + "\n\n"
-    else:
-        data = ""
-    return data
+def write_logs(executor, client, files, jobs, tail=None, max_bytes=None,
+               offsets=None):
+    """
+    retrieve log files in parallel and write them in order
+
+    files is a list of (node, fname). With offsets, a dict
+    'node_id/fname' -> offset, only the data after the offset is
+    retrieved and nodes without new data are omitted. The offsets
+    are updated after the data is written, an incomplete last line
+    is held back until it's complete.
+    """
+    files = collections.deque(files)
+    pending = collections.deque()
+    last_node = None
+    while files or pending:
+        while files and len(pending) < 2 * jobs:
+            node, fname = files.popleft()
+            key = "{}/{}".format(node['node_id'], fname)
+            offset = 0
+            if offsets is not None and key in offsets:
+                offset = offsets[key]
+            pending.append((node, key,
+                            executor.submit(node_file, client, node, fname,
+                                            None if offset else tail,
+                                            None if offset else max_bytes,
+                                            offset, offsets is not None)))
+        node, key, future = pending.popleft()
+        data, size = future.result()
+        with data:
+            if offsets is None or data.seek(0, io.SEEK_END) > 0:
+                data.seek(0)
+                if node is not last_node:
+                    sys.stdout.write("*** {} ({})\n\n".format(node['name'],
+                                                              node['node_id']))
+                    last_node = node
+                shutil.copyfileobj(data, sys.stdout)
+                sys.stdout.flush()
+        if offsets is not None:
+            offsets[key] = size
+
+def raw_file(client, node, fname):
+    """
+    get file from a node for the archive
+
+    Returns a spooled temporary file with the raw data, its SHA-256
+    hash, the number of lines and the trigrams of the lines. The file
+    is None, when it doesn't exist.
+    """
+    try:
+        resp = client.get(("/v2/projects", node['project_id'], "nodes",
+                           node['node_id'], "files", fname))
+        if resp.status == 404:
+            resp.read()
+            return (None, None, 0, None)
+        if resp.status != 200:
+            sys.exit("Can't get log file: {} {}".format(resp.status, resp.reason))
+        out = tempfile.SpooledTemporaryFile(max_size=SPOOL_SIZE)
+        sha256 = hashlib.sha256()
+        decoder = codecs.getincrementaldecoder('utf-8')(errors='ignore')
+        trigrams = set()
+        lines = 0
+        partial = ""
+        while True:
+            data = resp.read(CHUNK_SIZE)
+            out.write(data)
+            sha256.update(data)
+            text = partial + decoder.decode(data, not data)
+            text_lines = text.split("\n")
+            partial = "" if not data else text_lines.pop()
+            for line in text_lines:
+                line = line.lower()
+                trigrams.update(line[pos:pos+3] for pos in range(len(line) - 2))
+            lines += len(text_lines)
+            if not data:
+                break
+    except (OSError, http.client.HTTPException,
+            gns3api.GNS3ApiException) as err:
+        sys.exit("Can't get log file: {}".format(err))
+    out.seek(0)
+    return (out, sha256.hexdigest(), lines, trigrams)
+
+def bundle_key(name):
+    """ sort key of a bundle name, numbers are compared as numbers """
+    return [(int(part), "") if part.isdigit() else (-1, part)
+            for part in name[:-4].split("-")]
+
+def bundle_list(archive_dir):
+    """ sorted list of the bundle files in the archive directory """
+    try:
+        return sorted((name for name in os.listdir(archive_dir)
+                       if name.startswith("nodes_log-") and name.endswith(".zip")),
+                      key=bundle_key)
+    except OSError:
+        return []
+
+def create_bundle(archive_dir):
+    """
+    create a new bundle file, returns its name and the open file
+
+    The name contains the date and time, when a bundle with this
+    name already exists, a counter is appended.
+    """
+    base = time.strftime("nodes_log-%Y%m%d-%H%M%S")
+    name = base + ".zip"
+    count = 1
+    while True:
+        try:
+            return (name, open(os.path.join(archive_dir, name), "xb"))
+        except FileExistsError:
+            count += 1
+            name = "{}-{}.zip".format(base, count)
+
+def read_manifest(bundle):
+    """ read the manifest of a bundle """
+    with zipfile.ZipFile(bundle) as zfile:
+        return json.loads(zfile.read("manifest.json").decode('utf-8'))
+
+def write_archive(executor, client, files, jobs, archive_dir, project_id):
+    """
+    retrieve log files in parallel and write them into a bundle
+
+    The bundle is a ZIP file with a manifest, each file is stored as
+    an object named by its SHA-256 hash together with an index of its
+    trigrams. Objects, that are already in the previous bundle, are
+    only referenced in the manifest, if the bundle storing them still
+    exists.
+    """
+    known = {}				# sha256 -> bundle containing it
+    bundles = bundle_list(archive_dir)
+    if bundles:
+        try:
+            for entry in read_manifest(os.path.join(archive_dir, bundles[-1]))['files']:
+                if entry['bundle'] in bundles:
+                    known[entry['sha256']] = entry['bundle']
+        except (OSError, ValueError, KeyError, zipfile.BadZipFile) as err:
+            sys.exit("Can't read previous bundle: {}".format(err))
+    manifest = {'project_id': project_id,
+                'created': time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+                'files': []}
+    stored = 0
+    files = collections.deque(files)
+    pending = collections.deque()
+    try:
+        os.makedirs(archive_dir, exist_ok=True)
+        name, bundle = create_bundle(archive_dir)
+    except OSError as err:
+        sys.exit("Can't write archive: {}".format(err))
+    try:
+        with bundle, zipfile.ZipFile(bundle, "w", zipfile.ZIP_DEFLATED) as zfile:
+            while files or pending:
+                while files and len(pending) < 2 * jobs:
+                    node, fname = files.popleft()
+                    pending.append((node, fname,
+                                    executor.submit(raw_file, client, node, fname)))
+                node, fname, future = pending.popleft()
+                data, sha256, lines, trigrams = future.result()
+                if data is None:
+                    continue
+                with data:
+                    if sha256 not in known:
+                        with zfile.open("objects/" + sha256, "w") as member:
+                            shutil.copyfileobj(data, member)
+                        zfile.writestr("index/" + sha256,
+                                       json.dumps(sorted(trigrams)))
+                        known[sha256] = name
+                        stored += 1
+                    manifest['files'].append(
+                        {'node': node['name'], 'node_id': node['node_id'],
+                         'file': fname, 'sha256': sha256,
+                         'size': data.seek(0, io.SEEK_END), 'lines': lines,
+                         'bundle': known[sha256]})
+            zfile.writestr("manifest.json", json.dumps(manifest, indent=1))
+    except OSError as err:
+        os.remove(os.path.join(archive_dir, name))
+        sys.exit("Can't write archive: {}".format(err))
+    except BaseException:		# e.g. Ctrl-C, remove incomplete bundle
+        os.remove(os.path.join(archive_dir, name))
+        raise
+    print("Archive {}: {} files, {} stored, {} already archived"
+          .format(os.path.join(archive_dir, name), len(manifest['files']),
+                  stored, len(manifest['files']) - stored))
+
+def pattern_literals(pattern):
+    """
+    literal strings, that every match of a regex must contain
+
+    Only simple regular expressions are analyzed, for alternatives
+    and groups no literals are returned.
+    """
+    if '|' in pattern or '(' in pattern:
+        return []
+    literals = []
+    current = ""
+    pos = 0
+    while pos < len(pattern):
+        char = pattern[pos]
+        pos += 1
+        if char == '\\':
+            char = pattern[pos:pos+1]
+            pos += 1
+            if char and not char.isalnum():
+                current += char
+                continue
+        elif char in '*?{':		# previous char is optional
+            current = current[:-1]
+            if char == '{':
+                pos = pattern.find('}', pos) + 1 or len(pattern)
+        elif char == '[':
+            pos = pattern.find(']', pos + 1) + 1 or len(pattern)
+            if pattern[pos:pos+1] in ('*', '?', '{'):
+                pos += 1
+        elif char not in '+.^$':
+            current += char
+            continue
+        literals.append(current)
+        current = ""
+    literals.append(current)
+    return [literal for literal in literals if len(literal) >= 3]
+
+def grep_archive(bundle, pattern):
+    """
+    search a regex in the log files of a bundle
+
+    Only files, whose trigram index contains all trigrams of the
+    literal parts of the pattern, are decompressed and searched.
+    """
+    try:
+        regex = re.compile(pattern)
+    except re.error as err:
+        sys.exit("Invalid pattern: {}".format(err))
+    if os.path.isdir(bundle):
+        bundles = bundle_list(bundle)
+        if not bundles:
+            sys.exit("No bundle in {}".format(bundle))
+        bundle = os.path.join(bundle, bundles[-1])
+    required = set()
+    for literal in pattern_literals(pattern):
+        literal = literal.lower()
+        required.update(literal[pos:pos+3] for pos in range(len(literal) - 2))
+    zfiles = {}
+    matches = 0
+    try:
+        manifest = read_manifest(bundle)
+        for entry in manifest['files']:
+            zfile = zfiles.get(entry['bundle'])
+            if zfile is None:
+                zfile = zipfile.ZipFile(os.path.join(os.path.dirname(bundle),
+                                                     entry['bundle']))
+                zfiles[entry['bundle']] = zfile
+            if required:
+                trigrams = json.loads(zfile.read("index/" + entry['sha256'])
+                                      .decode('utf-8'))
+                if not required.issubset(trigrams):
+                    continue
+            with zfile.open("objects/" + entry['sha256']) as member:
+                text = io.TextIOWrapper(member, encoding='utf-8',
+                                        errors='ignore', newline="\n")
+                for lineno, line in enumerate(text, 1):
+                    line = line.rstrip("\r\n")
+                    if regex.search(line):
+                        sys.stdout.write("{}/{}:{}: {}\n"
+                                         .format(entry['node'], entry['file'],
+                                                 lineno, line))
+                        matches += 1
+    except (OSError, ValueError, KeyError, zipfile.BadZipFile) as err:
+        sys.exit("Can't read bundle: {}".format(err))
+    finally:
+        for zfile in zfiles.values():
+            zfile.close()
+    return matches
+
+def load_state(state_file, project_id):
+    """ load the file offsets of a project from the state file """
+    try:
+        with open(state_file, "r") as file:
+            state = json.load(file)
+    except FileNotFoundError:
+        return {}
+    except (OSError, ValueError) as err:
+        sys.exit("Can't read state file: {}".format(err))
+    offsets = state.get(project_id, {})
+    return offsets if isinstance(offsets, dict) else {}
+
+def save_state(state_file, project_id, offsets):
+    """ save the file offsets of a project in the state file """
+    try:
+        try:
+            with open(state_file, "r") as file:
+                state = json.load(file)
+        except (OSError, ValueError):
+            state = {}
+        state[project_id] = offsets
+        with open(state_file + ".tmp", "w") as file:
+            json.dump(state, file)
+        os.replace(state_file + ".tmp", state_file)
+    except OSError as err:
+        sys.exit("Can't write state file: {}".format(err))
 
 def nodes_log(argv):
     """ parse command line, retrieve nodes and get log of nodes """
 
     # get arguments
+    usage = "usage:\nnodes_log [-j num] [-t num] [-m num] " \
+            "[-f [-i sec] [-s file]] [-a dir] " \
+            "version parameter-file project-id [sel-item ...]\n" \
+            "nodes_log -g pattern bundle|dir"
+    try:
+        opts, args = getopt.getopt(argv[1:], "j:t:m:fi:s:a:g:",
+                                   ["jobs=", "tail=", "max-bytes=", "follow",
+                                    "interval=", "state=", "archive=",
+                                    "grep="])
+    except getopt.GetoptError as err:
+        sys.exit("{}\n{}".format(err, usage))
+    archive_dir = None
+    jobs = 8
+    tail = None
+    max_bytes = None
+    follow = False
+    interval = 2.0
+    state_file = os.path.join(os.path.expanduser("~"), ".nodes_log_state.json")
+    for opt, val in opts:
+        if opt in ("-f", "--follow"):
+            follow = True
+            continue
+        if opt in ("-s", "--state"):
+            state_file = val
+            continue
+        if opt in ("-a", "--archive"):
+            archive_dir = val
+            continue
+        if opt in ("-g", "--grep"):
+            if len(args) != 1:
+                sys.exit(usage)
+            if not grep_archive(args[0], val):
+                sys.exit(1)
+            return
+        try:
+            val = float(val) if opt in ("-i", "--interval") else int(val)
+        except ValueError:
+            val = 0
+        if opt in ("-j", "--jobs"):
+            jobs = val
+        elif opt in ("-t", "--tail"):
+            tail = val
+        elif opt in ("-m", "--max-bytes"):
+            max_bytes = val
+        elif opt in ("-i", "--interval"):
+            interval = val
+        if val <= 0:
+            sys.exit("Option {} needs a positive number".format(opt))
+    argv = argv[:1] + args
     if len(argv) < 4:
-        sys.exit("usage:\nstart_nodes version parameter-file project-id [sel-item ...]")
+        sys.exit(usage)
     try:
         with open(argv[2], "r") as file:
             cntl_url, cntl_user, cntl_passwd, *_ = file.read(512).splitlines()
@@ -68,26 +602,32 @@ def nodes_log(argv):
 
     sel_nodes.sort(key=lambda k: nodes[k]['name'].lower())
 
-    # get log of nodes
-    log = ""
-    for node_id in sel_nodes:
-        node = nodes[node_id]
-        log += "*** {} ({})\n\n".format(node['name'], node['node_id'])
-        if node['node_type'] == 'docker':
-            log += node_file(api, node, "vnc.log")
-        elif node['node_type'] == 'dynamips':
-            log += node_file(api, node,
-                             "{}_i{}_log.txt".format(
-                                 node['properties']['platform'],
-                                 node['properties']['dynamips_id']))
-        elif node['node_type'] == 'qemu':
-            log += node_file(api, node, "qemu.log")
-            log += node_file(api, node, "qemu-img.log")
-        elif node['node_type'] == 'vpcs':
-            log += node_file(api, node, "vpcs.log")
-        log += node_file(api, node, "ubridge.log")
-
-    sys.stdout.write(log)
+    # get log of nodes, the files are retrieved in parallel
+    # and written in order as soon as they are available
+    try:
+        client = StreamClient(cntl_url, cntl_user, cntl_passwd)
+    except gns3api.GNS3ApiException as err:
+        sys.exit("Can't connect to GNS3 controller: {}".format(err))
+    files = [(nodes[node_id], fname) for node_id in sel_nodes
+             for fname in log_files(nodes[node_id])]
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        if archive_dir:
+            write_archive(executor, client, files, jobs, archive_dir, project_id)
+            return
+        if not follow:
+            write_logs(executor, client, files, jobs, tail, max_bytes)
+            return
+
+        # follow mode, retrieve only new data, remember the offsets
+        offsets = load_state(state_file, project_id)
+        try:
+            while True:
+                write_logs(executor, client, files, jobs, tail, max_bytes,
+                           offsets)
+                save_state(state_file, project_id, offsets)
+                time.sleep(interval)
+        finally:			# e.g. on Ctrl-C
+            save_state(state_file, project_id, offsets)
 
 
 try:
@@ -2,19 +2,143 @@
 
 """
 paste.py - send list of commands one by one to the node
+
+usage: paste [-o dir] [-p profile] [-t file] [-w num]
+             version parameter-file project-id [sel-item ...]
+
+  -o dir, --output-dir=dir   write the output of each node into
+                             dir/<node name>.log, unsafe characters
+                             of the name are replaced by '_'
+  -p name, --profile=name    prompt profile: cisco, junos, linux or vpcs,
+                             default is selected by the node type/image
+                             or learned from the first prompt
+  -t file, --transcript=file write a transcript (JSON lines) with the
+                             timing of every command, at the end a
+                             latency histogram is printed
+  -w num, --window=num       send up to num commands without waiting
+                             for their prompt (default 1)
+
+The commands are sent as soon as they are read, paste doesn't wait
+for the end of the input. When multiple nodes are selected, the
+commands are sent to all of them at the same time. Without
+--output-dir each output line is prefixed by the node name, at the
+end a summary is printed.
+
+With a window greater than 1 the commands are pipelined. paste learns
+the hostname from the prompt and counts the prompts to keep track of
+the commands in flight. Interactive commands, like reload or copy,
+are sent one by one until the normal prompt shows up again.
+Show commands are also sent one by one, a pager would otherwise
+consume the next commands as keystrokes.
+
+The profile defines the prompt, the pager and the confirmation
+questions of a platform. Pagers are answered automatically,
+a confirmation question ends the wait for the prompt.
 """
 
+import asyncio
+import collections
+import getopt
+import json
 import os
+import re
 import sys
-import telnetlib
+import threading
+import time
 import gns3api
+from async_telnet import TelnetClient
+
+NO_MATCH = re.compile(b'(?!)')
+ERASE = re.compile(rb'\x08+ +\x08+|\r +\r')
+
+class Profile:
+    """ prompt, pager and confirmation patterns of a platform """
+
+    def __init__(self, prompt_chars, pager=None, confirm=None):
+        self._chars = re.escape(prompt_chars)
+        self.prompt = re.compile(rb'[' + self._chars + rb'] ?$')
+        self.prompt_line = re.compile(rb'\s*(\S+?)(\([^)]*\))?[' + self._chars + rb'] ?')
+        self.pager = re.compile(pager) if pager else NO_MATCH
+        self.confirm = re.compile(confirm) if confirm else NO_MATCH
+
+    def host_prompt(self, hostname):
+        """ compiled prompt of a host, matches at the start of a line """
+        return re.compile(rb'(?m)^\r*' + re.escape(hostname) +
+                          rb'(\([^)\r\n]*\))?[' + self._chars + rb']')
+
+PROFILES = {
+    'cisco': Profile(b'>#', pager=rb' ?--More-- ?$',
+                     confirm=rb'(\[confirm\]|\[yes/no\]:?|\[[^]\r\n]*\]\?|'
+                             rb'\? ?\[[^]\r\n]*\]:?) ?$'),
+    'junos': Profile(b'>#%', pager=rb'---\(more( \d+%)?\)--- ?$',
+                     confirm=rb'\[yes,no\] \(\w+\) ?$'),
+    'linux': Profile(b'#$', confirm=rb'\[[yY]/[nN]\] ?$'),
+    'vpcs': Profile(b'>')
+}
 
-def get_console(argv):
-    """ parse command line and retrieve console host and port """
+# used for the first contact, when the profile is not yet known
+GENERIC_PROFILE = Profile(b'>#%$')
+
+# node types / images and their profile
+NODE_TYPE_PROFILES = {'dynamips': 'cisco', 'iou': 'cisco',
+                      'vpcs': 'vpcs', 'docker': 'linux'}
+IMAGE_PROFILES = (
+    (re.compile(r'junos|vmx|vsrx|vqfx|olive|firefly', re.I), 'junos'),
+    (re.compile(r'ios|csr|xrv|nx-?os|n[357]k|n9kv|titanium|asa|veos|arista', re.I), 'cisco'),
+)
+
+# first prompt and its profile
+PROMPT_PROFILES = (
+    (re.compile(rb'^\s*[^\s@]+@[^\s:]+[>#%] ?$'), 'junos'),
+    (re.compile(rb'(\$|:\S*#) ?$'), 'linux'),
+    (re.compile(rb'[>#] ?$'), 'cisco'),
+)
+
+def node_profile(node):
+    """ get the prompt profile of a node, None if unknown """
+    if node['node_type'] in NODE_TYPE_PROFILES:
+        return NODE_TYPE_PROFILES[node['node_type']]
+    properties = node.get('properties') or {}
+    image = properties.get('hda_disk_image') or properties.get('image') or ''
+    for pattern, profile in IMAGE_PROFILES:
+        if pattern.search(image):
+            return profile
+    return None
+
+def learn_profile(prompt_line):
+    """ get the prompt profile from a prompt """
+    for pattern, profile in PROMPT_PROFILES:
+        if pattern.search(prompt_line):
+            return profile
+    return 'cisco'
+
+def get_consoles(argv):
+    """
+    parse command line and retrieve console host and port
+
+    Returns the options and a list of (node name, console host,
+    console port, prompt profile), sorted by node name.
+    """
 
     # get arguments
+    usage = "usage:\npaste [-o dir] [-p profile] [-t file] [-w num] " \
+            "version parameter-file project-id [sel-item ...]"
+    try:
+        opts, args = getopt.getopt(argv[1:], "o:p:t:w:",
+                                   ["output-dir=", "profile=", "transcript=",
+                                    "window="])
+        opts = dict(opts)
+        opts['window'] = int(opts.get('-w', opts.get('--window', 1)))
+        if opts['window'] < 1:
+            raise ValueError("window must be at least 1")
+        opts['profile'] = opts.get('-p', opts.get('--profile'))
+        if opts['profile'] and opts['profile'] not in PROFILES:
+            raise ValueError("unknown profile '{}'".format(opts['profile']))
+    except (getopt.GetoptError, ValueError) as err:
+        sys.exit("{}\n{}".format(err, usage))
+    argv = argv[:1] + args
     if len(argv) < 4:
-        sys.exit("usage:\npaste version parameter-file project-id [sel-item ...]")
+        sys.exit(usage)
     try:
         with open(argv[2], "r") as file:
             cntl_url, cntl_user, cntl_passwd, *_ = file.read(512).splitlines()
@@ -26,9 +150,6 @@ def get_console(argv):
     sel_nodes = [node[6:] for node in argv[4:] if node.startswith("nodes/")]
     if not sel_nodes:
         sys.exit("No node selected")
-    elif len(sel_nodes) != 1:
-        sys.exit("Select only one node")
-    node_id = sel_nodes[0]
 
     # connect to GNS3 controller
     try:
@@ -36,88 +157,442 @@ def get_console(argv):
     except gns3api.GNS3ApiException as err:
         sys.exit("Can't connect to GNS3 controller: {}".format(err))
 
+    consoles = []
+    computes = {}
     try:
-        node = api.request('GET', ('/v2/projects', project_id, 'nodes', node_id))
-        node_name = node['name']
-        if node['status'] != 'started':
-            sys.exit("Node '{}' is {}".format(node_name, node['status']))
-
-        console_port = node['console']
-        if not console_port:
-            sys.exit("Node '{}' doesn't use the console".format(node_name))
-        console_host = node['console_host']
-        if console_host in ('0.0.0.0', '::'):
-            compute = api.request('GET', ('/v2/computes', node['compute_id']))
-            console_host = compute['host']
+        for node_id in sel_nodes:
+            node = api.request('GET', ('/v2/projects', project_id, 'nodes', node_id))
+            node_name = node['name']
+            if node['status'] != 'started':
+                sys.exit("Node '{}' is {}".format(node_name, node['status']))
+
+            console_port = node['console']
+            if not console_port:
+                sys.exit("Node '{}' doesn't use the console".format(node_name))
+            console_host = node['console_host']
+            if console_host in ('0.0.0.0', '::'):
+                if node['compute_id'] not in computes:
+                    computes[node['compute_id']] = \
+                        api.request('GET', ('/v2/computes', node['compute_id']))
+                console_host = computes[node['compute_id']]['host']
+            profile = opts['profile'] or node_profile(node)
+            consoles.append((node_name, console_host, console_port, profile))
     except gns3api.GNS3ApiException as err:
         sys.exit("Can't get node information: {}".format(err))
 
-    return (node_name, console_host, console_port)
+    consoles.sort(key=lambda console: console[0].lower())
+    return (opts, consoles)
 
-def send_commands(node_name, console_host, console_port):
-    """ read commands from stdin and send them to the node """
+class PrefixWriter:
+    """ output writer, prefixes every line with the node name """
 
-    stdin_bin = sys.stdin.buffer
-    stdout_bin = sys.stdout.buffer
+    def __init__(self, name, out):
+        self._prefix = name.encode('utf-8', errors='replace') + b": "
+        self._out = out
+        self._partial = b""
 
-    prompt = b'[>#] ?$'
-    status = "???"
+    def write(self, data):
+        """ write data, only complete lines are written """
+        lines = (self._partial + data.replace(b'\r', b'')).split(b'\n')
+        self._partial = lines.pop()
+        for line in lines:
+            self._out.write(self._prefix + line + b'\n')
 
-    try:
+    def flush(self):
+        """ flush output """
+        self._out.flush()
+
+    def close(self):
+        """ write remaining partial line """
+        if self._partial:
+            self._out.write(self._prefix + self._partial + b'\n')
+            self._partial = b""
+        self._out.flush()
+
+class Transcript:
+    """ transcript of the commands (JSON lines) and their latency """
+
+    buckets = (0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1, 2, 5)
+
+    def __init__(self, file):
+        self._file = file
+        self._latency = []		# (time to prompt, node, command)
+
+    def close(self):
+        """ close the transcript file """
+        self._file.close()
+
+    def add(self, record):
+        """ add the record of a command """
+        self._file.write(json.dumps(record) + "\n")
+        self._latency.append((record['prompt'], record['node'],
+                              record['command']))
+
+    @staticmethod
+    def _duration(seconds):
+        """ format a duration """
+        if seconds < 1:
+            return "{:.0f}ms".format(seconds * 1000)
+        return "{:.2f}s".format(seconds)
+
+    def histogram(self):
+        """ print the latency histogram, the nodes and slowest commands """
+        if not self._latency:
+            return
+        latency = sorted(self._latency)
+        counts = [0] * (len(self.buckets) + 1)
+        for seconds, *_ in latency:
+            counts[sum(1 for limit in self.buckets if seconds >= limit)] += 1
+        print("\nTime to prompt of {} commands:".format(len(latency)))
+        labels = ["< " + self._duration(limit) for limit in self.buckets] + \
+                 [">= " + self._duration(self.buckets[-1])]
+        for label, count in zip(labels, counts):
+            print("  {:>8} {:6} {}".format(label, count,
+                                           "#" * round(count * 40 / len(latency))))
+
+        nodes = {}
+        for seconds, node, _ in latency:
+            nodes.setdefault(node, []).append(seconds)
+        if len(nodes) > 1:
+            print("Nodes:")
+            for node in sorted(nodes, key=str.lower):
+                times = nodes[node]
+                print("  {}: median {}, p95 {}, max {}".format(
+                    node, self._duration(times[len(times)//2]),
+                    self._duration(times[min(len(times)-1, int(len(times)*0.95))]),
+                    self._duration(times[-1])))
+
+        print("Slowest commands:")
+        for seconds, node, command in reversed(latency[-5:]):
+            print("  {:>8}  {}: {}".format(self._duration(seconds), node, command))
+
+class PasteSession:
+    """ telnet session to the console of a node """
+
+    interactive = re.compile(rb'\s*(reload|copy|write\s+erase|erase|delete|format|'
+                             rb'banner|crypto\s+key|clear|request|rollback|load|'
+                             rb'configure\s+replace|ping|traceroute|'
+                             rb'((do|run)\s+)?show|more)\b', re.I)
+
+    def __init__(self, name, host, port, out, profile=None, window=1,
+                 transcript=None):
+        self.name = name
+        self._host = host
+        self._port = port
+        self._out = out
+        self._profile = PROFILES[profile] if profile else None
+        self._window = window
+        self._transcript = transcript
+        self._inflight = collections.deque()	# commands without prompt
+        self._telnet = TelnetClient()
+        self._telnet.on_receive = self._received
+        self._prompt_line = b''
+        self._host_prompt = None
+        self.status = "???"
+        self.error = None
+        self.sent = 0
+
+    def close(self):
+        """ close connection """
+        self._telnet.close()
+
+    def _write(self, data):
+        """ write output, removes the erasure of the pager text """
+        if self._inflight:
+            self._inflight[0]['bytes'] += len(data)
+        self._out.write(ERASE.sub(b'', data))
+        self._out.flush()
+
+    def _send_command(self, line):
+        """ send a command and start its measurement """
+        self._telnet.write(line + b'\r')
+        self._inflight.append({'node': self.name,
+                               'command': line.decode('utf-8', errors='replace'),
+                               'sent': time.time(), 'start': time.monotonic(),
+                               'first_byte': None, 'bytes': 0})
+        self.sent += 1
+
+    def _received(self):
+        """ telnet callback, data has arrived """
+        if self._inflight and self._inflight[0]['first_byte'] is None:
+            self._inflight[0]['first_byte'] = time.monotonic()
+
+    def _finish_command(self, result):
+        """ the oldest command got its prompt, record it """
+        record = self._inflight.popleft()
+        now = time.monotonic()
+        if self._inflight and self._inflight[0]['first_byte'] is None and \
+           self._telnet.buffered():
+            self._inflight[0]['first_byte'] = now
+        if self._transcript:
+            start = record.pop('start')
+            if record['first_byte'] is not None:
+                record['first_byte'] = round(record['first_byte'] - start, 4)
+            record['sent'] = round(record['sent'], 3)
+            record['prompt'] = round(now - start, 4)
+            record['result'] = result
+            self._transcript.add(record)
+
+    async def _expect(self, prompt):
+        """
+        wait for the prompt and write the output, pagers are answered
+
+        Returns 0 on prompt, 1 on a confirmation question,
+        -1 on timeout.
+        """
+        profile = self._profile
+        while True:
+            (index, match, data) = await self._telnet.expect(
+                [prompt, profile.confirm, profile.pager], 5)
+            if index == 2:		# pager, write output without it
+                data = data[:len(data) - len(match.group(0))]
+                self._telnet.write(b' ')
+            self._write(data)
+            if index != 2:
+                if self._inflight:
+                    self._finish_command(("timeout", "prompt", "confirm")[index+1])
+                return index
+
+    async def connect(self):
+        """ open telnet connection and get the prompt """
+        telnet = self._telnet
 
         # open telnet connection
-        status = "connect"
-        telnet = telnetlib.Telnet(console_host, console_port, 10)
+        self.status = "connect"
+        await telnet.open(self._host, self._port, 10)
 
         # read old junk
-        while telnet.read_until(b'xyzzy', timeout=0.3):
-            pass
+        await telnet.read_idle(0.3)
 
         # send a <CR>
-        status = "first contact"
+        self.status = "first contact"
+        prompt = (self._profile or GENERIC_PROFILE).prompt
         telnet.write(b'\r')		# first <return>
-        try:
-            telnet.expect([prompt], 5)
-        except OSError:
-            pass
+        await telnet.expect([prompt], 5)
         telnet.write(b'\r')		# second <return>
-        (_, _, data) = telnet.expect([prompt], 5)
-        data = data.splitlines()[-1]
-
-        # get commands
-        status = "getting commands"
-        print("Paste commands, end with EOF...")
-        commands = stdin_bin.readlines()
-        print('')
-
-        # send commands
-        status = "sending commands"
-        stdout_bin.write(data)
-        stdout_bin.flush()
-        for line in commands:
+        (_, _, data) = await telnet.expect([prompt], 5)
+        self._prompt_line = data.splitlines()[-1] if data else b''
+        if not self._profile:
+            self._profile = PROFILES[learn_profile(self._prompt_line)]
+
+        # learn the hostname, needed to count the prompts
+        match = self._profile.prompt_line.fullmatch(self._prompt_line)
+        if match:
+            self._host_prompt = self._profile.host_prompt(match.group(1))
+
+    async def _wait_prompts(self, pending, keep=0):
+        """
+        wait for the prompts of the pipelined commands, until only
+        keep commands are in flight, returns the commands in flight
+
+        On timeout the commands in flight are considered lost,
+        the prompt counting restarts.
+        """
+        while pending > keep:
+            if await self._expect(self._host_prompt) < 0:
+                while self._inflight:
+                    self._finish_command("timeout")
+                return 0
+            pending -= 1
+        return pending
+
+    async def send(self, commands):
+        """
+        send commands, pipelined up to the window size
+
+        The commands are taken from a queue, None marks the end.
+        """
+        telnet = self._telnet
+        self.status = "sending commands"
+        self._write(self._prompt_line)
+        window = self._window if self._host_prompt else 1
+        pending = 0			# commands waiting for their prompt
+        lockstep = False
+        while True:
+            if pending and commands.empty():
+                pending = await self._wait_prompts(pending)
+            line = await commands.get()
+            if line is None:
+                break
             line = line.rstrip(b'\r\n')
-            while True:
-                data = telnet.read_until(b'xyzzy', timeout=0.2)
-                if not data:
-                    break
-                stdout_bin.write(data)
-                stdout_bin.flush()
-            telnet.write(line + b'\r')
-            (_, _, data) = telnet.expect([prompt], 5)
-            stdout_bin.write(data)
-            stdout_bin.flush()
+            if window > 1 and not lockstep and not self.interactive.match(line):
+                if pending >= window:
+                    pending = await self._wait_prompts(pending, window - 1)
+                self._send_command(line)
+                await telnet.drain()
+                pending += 1
+                continue
+
+            # lock-step: one command, then wait for its prompt
+            pending = await self._wait_prompts(pending)
+            data = telnet.read_available()
+            if data:
+                self._write(data)
+            self._send_command(line)
+            lockstep = await self._expect(self._profile.prompt) != 0
+        await self._wait_prompts(pending)
+        self._write(telnet.read_available())
 
         # close connection
-        status = "close"
+        self.status = "close"
         telnet.close()
-        print('')
 
+    async def run(self, step, *args):
+        """ run a step (a coroutine method), errors are saved in self.error """
+        if self.error:
+            return
+        try:
+            await step(*args)
+        except (OSError, EOFError, asyncio.TimeoutError) as err:
+            self.close()
+            if isinstance(err, EOFError):
+                err = "connection closed"
+            elif isinstance(err, asyncio.TimeoutError):
+                err = "timeout"
+            self.error = "I/O error during {} - {}".format(self.status, err)
+
+def read_commands(queues):
+    """
+    read commands from stdin
+
+    A thread reads the lines as they arrive and puts them into all
+    queues, None marks the end of the input.
+    """
+    loop = asyncio.get_running_loop()
+
+    def distribute(line):
+        for queue in queues:
+            queue.put_nowait(line)
+
+    def reader():
+        try:
+            try:
+                for line in sys.stdin.buffer:
+                    loop.call_soon_threadsafe(distribute, line)
+            except OSError:
+                pass
+            loop.call_soon_threadsafe(distribute, None)
+        except RuntimeError:		# event loop is already closed
+            pass
+
+    print("Paste commands, end with EOF...")
+    sys.stdout.flush()
+    threading.Thread(target=reader, daemon=True).start()
+
+async def send_commands(node_name, console_host, console_port, profile,
+                        window=1, transcript=None):
+    """ read commands from stdin and send them to the node """
+    session = PasteSession(node_name, console_host, console_port,
+                           sys.stdout.buffer, profile, window, transcript)
+    try:
+        await session.run(session.connect)
+        if not session.error:
+            commands = asyncio.Queue()
+            read_commands([commands])
+            await session.run(session.send, commands)
+    finally:
+        session.close()
+    if session.error:
+        sys.exit("\n{}: {}\n".format(node_name, session.error))
+    print('')
+    if transcript:
+        transcript.histogram()
+
+def log_filename(node_name, used):
+    """
+    file name of the output of a node
+
+    Path separators and characters, that are not allowed on Windows,
+    are replaced by '_', a leading dot too. A number is appended on
+    a collision, used holds the names already taken (lower case).
+    """
+    name = re.sub(r'[\x00-\x1f/\\:*?"<>|]', '_', node_name).strip()
+    name = re.sub(r'^\.', '_', name) or '_'
+    filename = name + ".log"
+    num = 1
+    while filename.lower() in used:
+        num += 1
+        filename = "{}-{}.log".format(name, num)
+    used.add(filename.lower())
+    return filename
+
+async def broadcast_commands(consoles, output_dir=None, window=1,
+                             transcript=None):
+    """ read commands from stdin and send them to all nodes at once """
+    stdout_bin = sys.stdout.buffer
+    sessions = []
+    outputs = []
+    filenames = set()
+    try:
+        for node_name, console_host, console_port, profile in consoles:
+            if output_dir:
+                out = open(os.path.join(output_dir,
+                                        log_filename(node_name, filenames)),
+                           "wb")
+            else:
+                out = PrefixWriter(node_name, stdout_bin)
+            outputs.append(out)
+            sessions.append(PasteSession(node_name, console_host, console_port,
+                                         out, profile, window, transcript))
+        await asyncio.gather(*(session.run(session.connect)
+                               for session in sessions))
+        queues = [asyncio.Queue() for session in sessions]
+        read_commands([queue for session, queue in zip(sessions, queues)
+                       if not session.error])
+        await asyncio.gather(*(session.run(session.send, queue)
+                               for session, queue in zip(sessions, queues)))
+    finally:
+        for session in sessions:
+            session.close()
+        for out in outputs:
+            out.close()
+
+    # summary
+    print('')
+    failed = 0
+    for session in sessions:
+        if session.error:
+            failed += 1
+            print("{}: failed, {}".format(session.name, session.error))
+        else:
+            print("{}: ok, {} commands".format(session.name, session.sent))
+    if transcript:
+        transcript.histogram()
+    if failed:
+        sys.exit("{} of {} nodes failed".format(failed, len(sessions)))
+
+def main(argv):
+    """ get consoles of the nodes and send the commands """
+    opts, consoles = get_consoles(argv)
+    output_dir = opts.get('-o', opts.get('--output-dir'))
+    try:
+        if output_dir:
+            os.makedirs(output_dir, exist_ok=True)
     except OSError as err:
-        sys.exit("\n{}: I/O error during {} - {}\n".format(node_name, status, err))
+        sys.exit("Can't create output directory: {}".format(err))
+    transcript = None
+    transcript_file = opts.get('-t', opts.get('--transcript'))
+    try:
+        if transcript_file:
+            transcript = Transcript(open(transcript_file, "w"))
+    except OSError as err:
+        sys.exit("Can't create transcript: {}".format(err))
+    try:
+        if len(consoles) == 1 and not output_dir:
+            asyncio.run(send_commands(*consoles[0], opts['window'], transcript))
+        else:
+            asyncio.run(broadcast_commands(consoles, output_dir, opts['window'],
+                                           transcript))
     except KeyboardInterrupt:
-        telnet.close()
-        sys.exit("\n{}: Aborted\n".format(node_name))
+        if len(consoles) == 1:
+            sys.exit("\n{}: Aborted\n".format(consoles[0][0]))
+        sys.exit("\nAborted\n")
+    except OSError as err:
+        sys.exit("Can't write output: {}".format(err))
+    finally:
+        if transcript:
+            transcript.close()
 
 
 if __name__ == "__main__":
-    send_commands(*get_console(sys.argv))
+    main(sys.argv)
@@ -0,0 +1,428 @@
+#!/usr/local/bin/python3
+
+"""
+paste_bench - throughput benchmark of paste
+
+usage: paste_bench [-n nodes] [-s sizes] [-w windows] [-v style] [-d delay]
+                   [-L latency] [-l lines] [-p lines] [-r rate] [-S]
+
+  -n num, --nodes=num           number of nodes (default 1)
+  -s list, --sizes=list         config sizes in commands, comma separated
+                                (default 100,1000)
+  -w list, --windows=list       paste windows, comma separated (default 1,8)
+  -v style, --style=style       console style: cisco or junos (default cisco)
+  -d sec, --delay=sec           processing delay per command (default 0.002)
+  -L sec, --latency=sec         round trip time of the console connection
+                                (default 0.01)
+  -l num, --lines=num           output lines of a show command (default 20)
+  -p num, --pager=num           pager after num lines, 0 = no pager
+                                (default 0)
+  -r num, --rate=num            console output rate in bytes/s,
+                                0 = unlimited (default 0)
+  -S, --serve                   only run the consoles and the controller,
+                                print the paste arguments
+
+The benchmark runs locally: emulated telnet consoles and a minimal
+GNS3 controller, that returns the console host and port of the nodes.
+paste is run for every config size and window, the result is the
+commands/s and the time to prompt (median, p95, p99, max) taken
+from the paste transcript.
+"""
+
+import asyncio
+import getopt
+import json
+import os
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+IAC, DONT, DO, WONT, WILL, SB, SE = 255, 254, 253, 252, 251, 250, 240
+ECHO, SGA = 1, 3
+
+PASTE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "paste.py")
+PROJECT_ID = str(uuid.uuid4())
+
+class Input:
+    """ console input, telnet commands are removed """
+
+    def __init__(self, reader):
+        self._reader = reader
+        self._raw = bytearray()
+        self._buffer = bytearray()
+
+    async def _fill(self):
+        """ receive data, returns False at the end of the connection """
+        data = await self._reader.read(4096)
+        if not data:
+            return False
+        raw = self._raw
+        raw += data
+        pos = 0
+        while pos < len(raw):
+            if raw[pos] != IAC:
+                self._buffer.append(raw[pos])
+                pos += 1
+            elif pos + 1 >= len(raw):
+                break
+            elif raw[pos+1] == IAC:
+                self._buffer.append(IAC)
+                pos += 2
+            elif raw[pos+1] in (DO, DONT, WILL, WONT):
+                if pos + 2 >= len(raw):
+                    break
+                pos += 3
+            elif raw[pos+1] == SB:
+                end = raw.find(bytes((IAC, SE)), pos+2)
+                if end < 0:
+                    break
+                pos = end + 2
+            else:
+                pos += 2
+        del raw[:pos]
+        return True
+
+    async def readline(self):
+        """ read a line, None at the end of the connection """
+        while True:
+            end = self._buffer.find(b'\r')
+            if end >= 0:
+                line = bytes(self._buffer[:end])
+                del self._buffer[:end+1]
+                return line.replace(b'\n', b'').replace(b'\0', b'')
+            if not await self._fill():
+                return None
+
+    async def readkey(self):
+        """ read a single key, None at the end of the connection """
+        while not self._buffer:
+            if not await self._fill():
+                return None
+        key = self._buffer[:1]
+        del self._buffer[:1]
+        return bytes(key)
+
+class Output:
+    """ console output, delayed by the latency, limited to rate bytes/s """
+
+    def __init__(self, writer, latency, rate):
+        self._writer = writer
+        self._latency = latency
+        self._rate = rate
+        self._queue = asyncio.Queue()
+        self._task = asyncio.create_task(self._send())
+
+    def close(self):
+        """ stop sending """
+        self._task.cancel()
+
+    async def write(self, data):
+        """ write data """
+        self._queue.put_nowait((time.monotonic() + self._latency, data))
+
+    async def _send(self):
+        """ task, sends the data when it's due """
+        try:
+            while True:
+                due, data = await self._queue.get()
+                if due > time.monotonic():
+                    await asyncio.sleep(due - time.monotonic())
+                if not self._rate:
+                    self._writer.write(data)
+                    await self._writer.drain()
+                    continue
+                chunk = max(1, self._rate // 100)
+                for pos in range(0, len(data), chunk):
+                    self._writer.write(data[pos:pos+chunk])
+                    await self._writer.drain()
+                    await asyncio.sleep(len(data[pos:pos+chunk]) / self._rate)
+        except OSError:
+            pass
+
+class Console:
+    """ emulated cisco/juniper console """
+
+    def __init__(self, name, style, settings):
+        self.name = name
+        self._style = style
+        self._delay = settings['delay']
+        self._latency = settings['latency']
+        self._lines = settings['lines']
+        self._pager = settings['pager']
+        self._rate = settings['rate']
+
+    def prompt(self, mode):
+        """ prompt of the current mode """
+        if self._style == 'junos':
+            if mode:
+                return "\r\n[edit]\r\nuser@{}# ".format(self.name).encode()
+            return "user@{}> ".format(self.name).encode()
+        return "{}{}#".format(self.name, mode).encode()
+
+    async def show(self, inp, out, command):
+        """ output of a show command, with pager """
+        if self._style == 'junos':
+            pager = b"---(more)---"
+            erase = b"\r" + b" " * len(pager) + b"\r"
+        else:
+            pager = b" --More-- "
+            erase = b"\x08" * len(pager) + b" " * len(pager) + b"\x08" * len(pager)
+        for num in range(self._lines):
+            if self._pager and num and num % self._pager == 0:
+                await out.write(pager)
+                if await inp.readkey() is None:
+                    return
+                await out.write(erase)
+            await out.write("{} {:4}: {} ".format(self.name, num, command)
+                            .ljust(70, '.').encode() + b"\r\n")
+
+    async def execute(self, inp, out, line, mode):
+        """ execute a command, returns the new mode """
+        words = line.decode('utf-8', errors='replace').split()
+        if words and words[0] in ('do', 'run'):
+            words = words[1:]
+        word = words[0].lower() if words else ''
+        if word == 'show':
+            await self.show(inp, out, ' '.join(words))
+        elif self._style == 'junos':
+            if word == 'configure':
+                await out.write(b"Entering configuration mode\r\n")
+                mode = 'config'
+            elif word in ('exit', 'quit') and mode:
+                await out.write(b"Exiting configuration mode\r\n")
+                mode = ''
+            elif word == 'commit':
+                await out.write(b"commit complete\r\n")
+            elif word == 'request':
+                await out.write(b"Reboot the system ? [yes,no] (no) ")
+                await out.write((await inp.readline() or b'') + b"\r\n")
+        else:
+            if word in ('conf', 'configure'):
+                mode = '(config)'
+            elif word in ('interface', 'router', 'line') and mode:
+                mode = '(config-{})'.format(word[:2])
+            elif word == 'exit' and mode:
+                mode = '(config)' if mode != '(config)' else ''
+            elif word == 'end':
+                mode = ''
+            elif word == 'reload':
+                await out.write(b"Proceed with reload? [confirm]")
+                await out.write((await inp.readline() or b'') + b"\r\n")
+        return mode
+
+    async def session(self, reader, writer):
+        """ telnet session """
+        inp = Input(reader)
+        out = Output(writer, self._latency, self._rate)
+        mode = ''
+        try:
+            writer.write(bytes((IAC, WILL, ECHO, IAC, WILL, SGA)))
+            while True:
+                line = await inp.readline()
+                if line is None:
+                    break
+                await out.write(line + b"\r\n")
+                if line and self._delay:
+                    await asyncio.sleep(self._delay)
+                mode = await self.execute(inp, out, line, mode)
+                await out.write(self.prompt(mode))
+        except OSError:
+            pass
+        finally:
+            out.close()
+            writer.close()
+
+class RequestHandler(BaseHTTPRequestHandler):
+    """ GNS3 controller, returns the node information """
+
+    protocol_version = 'HTTP/1.1'
+    nodes = {}
+
+    def log_message(self, format, *args):	# pylint: disable=redefined-builtin
+        pass
+
+    def send_json(self, status, data):
+        """ send a JSON response """
+        body = json.dumps(data).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):				# pylint: disable=invalid-name
+        """ GET request """
+        path = self.path.split('?')[0].rstrip('/').split('/')
+        if path == ['', 'v2', 'version']:
+            self.send_json(200, {'version': '2.2.0', 'local': False})
+        elif len(path) == 6 and path[1:3] == ['v2', 'projects'] and \
+             path[3] == PROJECT_ID and path[4] == 'nodes' and \
+             path[5] in self.nodes:
+            self.send_json(200, self.nodes[path[5]])
+        elif len(path) == 4 and path[1:3] == ['v2', 'computes']:
+            self.send_json(200, {'compute_id': path[3], 'host': '127.0.0.1'})
+        else:
+            self.send_json(404, {'message': "Not found", 'status': 404})
+
+def generate_config(style, size):
+    """ generate a configuration of size commands """
+    commands = []
+    num = 0
+    while len(commands) < size:
+        if style == 'junos':
+            if num % 50 == 0:
+                commands += ["configure"] if num == 0 else ["commit", "run show interfaces terse"]
+            commands += ["set interfaces ge-0/0/{0} description link{0}".format(num),
+                         "set interfaces ge-0/0/{0} unit 0 family inet address "
+                         "10.{1}.{2}.1/24".format(num, num // 256, num % 256)]
+        else:
+            if num % 50 == 0:
+                commands += ["configure terminal"] if num == 0 else ["do show ip interface brief"]
+            commands += ["interface Ethernet{}/{}".format(num // 16, num % 16),
+                         " description link{}".format(num),
+                         " ip address 10.{}.{}.1 255.255.255.0".format(num // 256, num % 256),
+                         " no shutdown",
+                         " exit"]
+        num += 1
+    commands = commands[:size-1] + ["commit" if style == 'junos' else "end"]
+    return "".join(command + "\n" for command in commands).encode()
+
+def percentile(values, fraction):
+    """ percentile of sorted values """
+    return values[min(len(values)-1, int(len(values) * fraction))]
+
+async def run_paste(param_file, node_ids, config, window):
+    """ run paste, returns (wall time, transcript records, error) """
+    env = dict(os.environ)
+    path = [os.path.dirname(PASTE), os.path.dirname(os.path.dirname(PASTE))]
+    if env.get('PYTHONPATH'):
+        path.append(env['PYTHONPATH'])
+    env['PYTHONPATH'] = os.pathsep.join(path)
+    with tempfile.TemporaryDirectory() as tmpdir:
+        transcript = os.path.join(tmpdir, "transcript.jsonl")
+        start = time.monotonic()
+        proc = await asyncio.create_subprocess_exec(
+            sys.executable, PASTE, "-w", str(window), "-t", transcript,
+            "2.2", param_file, PROJECT_ID,
+            *["nodes/" + node_id for node_id in node_ids],
+            stdin=asyncio.subprocess.PIPE, stdout=asyncio.subprocess.DEVNULL,
+            stderr=asyncio.subprocess.PIPE, env=env)
+        _, stderr = await proc.communicate(config)
+        wall = time.monotonic() - start
+        try:
+            with open(transcript, "r") as file:
+                records = [json.loads(line) for line in file]
+        except (OSError, ValueError):
+            records = []
+    error = stderr.decode('utf-8', errors='replace').strip() \
+            if proc.returncode else None
+    return (wall, records, error)
+
+async def benchmark(opts, settings):
+    """ start consoles and controller, run the benchmarks """
+
+    # consoles
+    servers = []
+    for num in range(opts['nodes']):
+        name = "R{}".format(num+1)
+        console = Console(name, opts['style'], settings)
+        server = await asyncio.start_server(console.session, '127.0.0.1', 0)
+        servers.append(server)
+        node_id = str(uuid.uuid4())
+        node = {'node_id': node_id, 'name': name, 'status': 'started',
+                'console': server.sockets[0].getsockname()[1],
+                'console_host': '127.0.0.1', 'compute_id': 'local',
+                'node_type': 'dynamips', 'properties': {}}
+        if opts['style'] == 'junos':
+            node['node_type'] = 'qemu'
+            node['properties'] = {'hda_disk_image': 'junos-vmx.qcow2'}
+        RequestHandler.nodes[node_id] = node
+
+    # controller
+    httpd = ThreadingHTTPServer(('127.0.0.1', 0), RequestHandler)
+    httpd.daemon_threads = True
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+
+    with tempfile.NamedTemporaryFile("w", suffix=".param", delete=False) as file:
+        file.write("http://127.0.0.1:{}\n\n\n".format(httpd.server_address[1]))
+        param_file = file.name
+    node_ids = list(RequestHandler.nodes)
+    try:
+        if opts['serve']:
+            print("paste 2.2 {} {} {}".format(
+                param_file, PROJECT_ID,
+                " ".join("nodes/" + node_id for node_id in node_ids)))
+            sys.stdout.flush()
+            await asyncio.Event().wait()
+
+        print("{:>5} {:>8} {:>6} {:>8} {:>8} {:>8} {:>8} {:>8} {:>8} {:>8}".format(
+            "nodes", "commands", "window", "wall", "cmd/s",
+            "median", "p95", "p99", "max", "timeouts"))
+        for size in opts['sizes']:
+            config = generate_config(opts['style'], size)
+            for window in opts['windows']:
+                wall, records, error = await run_paste(param_file, node_ids,
+                                                       config, window)
+                if error or not records:
+                    print("{:5} {:8} {:6}  paste failed: {}".format(
+                        len(node_ids), size, window, error or "no transcript"))
+                    continue
+                latency = sorted(record['prompt'] for record in records)
+                span = max(record['sent'] + record['prompt'] for record in records) - \
+                       min(record['sent'] for record in records)
+                timeouts = sum(1 for record in records if record['result'] == 'timeout')
+                print("{:5} {:8} {:6} {:7.2f}s {:8.0f} {:7.1f}ms {:6.1f}ms "
+                      "{:6.1f}ms {:6.1f}ms {:8}".format(
+                          len(node_ids), size, window, wall,
+                          len(records) / span if span > 0 else 0,
+                          percentile(latency, 0.5) * 1000,
+                          percentile(latency, 0.95) * 1000,
+                          percentile(latency, 0.99) * 1000,
+                          latency[-1] * 1000, timeouts))
+                sys.stdout.flush()
+    finally:
+        os.remove(param_file)
+        httpd.shutdown()
+        for server in servers:
+            server.close()
+
+def main(argv):
+    """ parse command line and run the benchmark """
+    usage = "usage: paste_bench [-n nodes] [-s sizes] [-w windows] [-v style] " \
+            "[-d delay] [-L latency] [-l lines] [-p lines] [-r rate] [-S]"
+    try:
+        opts, args = getopt.getopt(argv[1:], "n:s:w:v:d:L:l:p:r:S",
+                                   ["nodes=", "sizes=", "windows=", "style=",
+                                    "delay=", "latency=", "lines=", "pager=", "rate=",
+                                    "serve"])
+        opts = dict(opts)
+        bench = {
+            'nodes': int(opts.get('-n', opts.get('--nodes', 1))),
+            'sizes': [int(size) for size in
+                      opts.get('-s', opts.get('--sizes', "100,1000")).split(',')],
+            'windows': [int(window) for window in
+                        opts.get('-w', opts.get('--windows', "1,8")).split(',')],
+            'style': opts.get('-v', opts.get('--style', 'cisco')),
+            'serve': '-S' in opts or '--serve' in opts}
+        settings = {
+            'delay': float(opts.get('-d', opts.get('--delay', 0.002))),
+            'latency': float(opts.get('-L', opts.get('--latency', 0.01))),
+            'lines': int(opts.get('-l', opts.get('--lines', 20))),
+            'pager': int(opts.get('-p', opts.get('--pager', 0))),
+            'rate': int(opts.get('-r', opts.get('--rate', 0)))}
+    except (getopt.GetoptError, ValueError) as err:
+        sys.exit("{}\n{}".format(err, usage))
+    if args or bench['nodes'] < 1 or bench['style'] not in ('cisco', 'junos') or \
+       min(bench['sizes']) < 1 or min(bench['windows']) < 1:
+        sys.exit(usage)
+
+    asyncio.run(benchmark(bench, settings))
+
+
+try:
+    main(sys.argv)
+except KeyboardInterrupt:
+    pass
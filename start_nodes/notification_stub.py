@@ -0,0 +1,239 @@
+#!/usr/local/bin/python3
+
+"""
+notification_stub - minimal GNS3 controller to test start_nodes
+
+usage: notification_stub [-p port] [-c computes] [-n nodes] [-f failing]
+                         [-o parameter-file]
+
+  -p port, --port=port          TCP port (default 3080)
+  -c num, --computes=num        number of computes (default 2)
+  -n num, --nodes=num           number of nodes (default 10)
+  -f num, --fail=num            number of nodes, that stop after their start
+  -o file, --parameter-file=file
+                                write controller connection parameters,
+                                to be used as start_nodes parameter-file
+
+The stub serves the requests used by start_nodes and the notification
+streams of the controller and of the project. The compute load rises
+with every started node and decays afterwards.
+"""
+
+import getopt
+import json
+import queue
+import re
+import sys
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+NODE_TYPES = (('ethernet_switch', {}), ('qemu', {'ram': 1024, 'cpus': 1}),
+              ('dynamips', {'ram': 256}), ('iou', {'ram': 256}),
+              ('vpcs', {}), ('docker', {}))
+
+class Controller:
+    """ simulated controller state """
+
+    def __init__(self, computes, nodes, failing):
+        self.lock = threading.Lock()
+        self.project_id = str(uuid.uuid4())
+        self.subscribers = {}		# stream -> list of queues
+        self.computes = {}
+        for num in range(computes):
+            compute_id = "compute{}".format(num+1)
+            self.computes[compute_id] = {
+                'compute_id': compute_id, 'name': compute_id,
+                'host': '127.0.0.1', 'connected': True,
+                'cpu_usage_percent': 5.0, 'memory_usage_percent': 20.0,
+                'capabilities': {'cpus': 8, 'memory': 16 * 1024**3}}
+        compute_ids = sorted(self.computes)
+        self.nodes = {}
+        for num in range(nodes):
+            node_type, properties = NODE_TYPES[num % len(NODE_TYPES)]
+            node_id = str(uuid.uuid4())
+            self.nodes[node_id] = {
+                'node_id': node_id, 'project_id': self.project_id,
+                'name': "{}{}".format(node_type.split('_')[-1], num+1),
+                'node_type': node_type, 'status': 'stopped',
+                'compute_id': compute_ids[num % len(compute_ids)],
+                'console': 5000 + num, 'console_host': '127.0.0.1',
+                'console_type': 'telnet',
+                'properties': dict(properties)}
+        self.failing = set(sorted(self.nodes)[:failing])
+        node_ids = sorted(self.nodes, key=lambda k: self.nodes[k]['name'])
+        self.links = [
+            {'link_id': str(uuid.uuid4()), 'project_id': self.project_id,
+             'suspend': False, 'filters': {},
+             'nodes': [{'node_id': node_ids[0], 'adapter_number': 0,
+                        'port_number': num},
+                       {'node_id': node_id, 'adapter_number': 0,
+                        'port_number': 0}]}
+            for num, node_id in enumerate(node_ids[1:])]
+
+    def notify(self, stream, action, event):
+        """ send a notification to all subscribers of a stream """
+        with self.lock:
+            for subscriber in self.subscribers.get(stream, []):
+                subscriber.put({'action': action, 'event': dict(event)})
+
+    def subscribe(self, stream):
+        """ subscribe to a stream """
+        subscriber = queue.Queue()
+        with self.lock:
+            self.subscribers.setdefault(stream, []).append(subscriber)
+        return subscriber
+
+    def unsubscribe(self, stream, subscriber):
+        """ unsubscribe from a stream """
+        with self.lock:
+            self.subscribers[stream].remove(subscriber)
+
+    def start_node(self, node):
+        """ start a node, failing nodes stop after a second """
+        compute = self.computes[node['compute_id']]
+        with self.lock:
+            node['status'] = 'started'
+            compute['cpu_usage_percent'] = min(100.0, compute['cpu_usage_percent'] + 20)
+            compute['memory_usage_percent'] = min(100.0, compute['memory_usage_percent'] +
+                                                  node['properties'].get('ram', 64) / 163.84)
+        self.notify('project', 'node.updated', node)
+        if node['node_id'] in self.failing:
+            def fail():
+                with self.lock:
+                    node['status'] = 'stopped'
+                self.notify('project', 'node.updated', node)
+                self.notify('project', 'log.error',
+                            {'node_id': node['node_id'],
+                             'message': "{} has crashed".format(node['name'])})
+            threading.Timer(1.0, fail).start()
+
+    def load_updater(self):
+        """ thread, decays the CPU load and sends compute updates """
+        while True:
+            time.sleep(1)
+            for compute in self.computes.values():
+                with self.lock:
+                    compute['cpu_usage_percent'] = max(5.0, compute['cpu_usage_percent'] * 0.7)
+                self.notify('controller', 'compute.updated', compute)
+
+class RequestHandler(BaseHTTPRequestHandler):
+    """ HTTP request handler """
+
+    protocol_version = 'HTTP/1.1'
+    controller = None
+
+    def log_message(self, format, *args):	# pylint: disable=redefined-builtin
+        pass
+
+    def send_json(self, status, data):
+        """ send a JSON response """
+        body = json.dumps(data).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_stream(self, stream):
+        """ send a notification stream, chunked encoding """
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+        subscriber = self.controller.subscribe(stream)
+        try:
+            while True:
+                try:
+                    message = subscriber.get(timeout=5)
+                except queue.Empty:
+                    message = {'action': 'ping', 'event': {}}
+                data = (json.dumps(message) + "\n").encode('utf-8')
+                self.wfile.write("{:x}\r\n".format(len(data)).encode('ascii') +
+                                 data + b"\r\n")
+                self.wfile.flush()
+        except OSError:
+            pass
+        finally:
+            self.controller.unsubscribe(stream, subscriber)
+
+    def do_GET(self):				# pylint: disable=invalid-name
+        """ GET request """
+        cntl = self.controller
+        path = self.path.split('?')[0].rstrip('/')
+        project = '/v2/projects/' + cntl.project_id
+        match = re.fullmatch(r'/v2/computes/([^/]+)', path)
+        node_match = re.fullmatch(re.escape(project) + r'/nodes/([^/]+)', path)
+        if path == '/v2/version':
+            self.send_json(200, {'version': '2.2.0', 'local': False})
+        elif path == '/v2/notifications':
+            self.send_stream('controller')
+        elif path == project + '/notifications':
+            self.send_stream('project')
+        elif path == project + '/nodes':
+            with cntl.lock:
+                self.send_json(200, list(cntl.nodes.values()))
+        elif node_match and node_match.group(1) in cntl.nodes:
+            with cntl.lock:
+                self.send_json(200, cntl.nodes[node_match.group(1)])
+        elif path == project + '/links':
+            self.send_json(200, cntl.links)
+        elif match and match.group(1) in cntl.computes:
+            with cntl.lock:
+                self.send_json(200, cntl.computes[match.group(1)])
+        else:
+            self.send_json(404, {'message': "Not found", 'status': 404})
+
+    def do_POST(self):				# pylint: disable=invalid-name
+        """ POST request """
+        cntl = self.controller
+        self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        match = re.fullmatch(r'/v2/projects/([^/]+)/nodes/([^/]+)/start',
+                             self.path)
+        if match and match.group(1) == cntl.project_id and \
+           match.group(2) in cntl.nodes:
+            node = cntl.nodes[match.group(2)]
+            time.sleep(0.2)
+            cntl.start_node(node)
+            self.send_json(200, node)
+        else:
+            self.send_json(404, {'message': "Not found", 'status': 404})
+
+def main(argv):
+    """ parse command line and run the stub controller """
+    usage = "usage: notification_stub [-p port] [-c computes] [-n nodes] " \
+            "[-f failing] [-o parameter-file]"
+    try:
+        opts, args = getopt.getopt(argv[1:], "p:c:n:f:o:",
+                                   ["port=", "computes=", "nodes=", "fail=",
+                                    "parameter-file="])
+        opts = dict(opts)
+        port = int(opts.get('-p', opts.get('--port', 3080)))
+        computes = int(opts.get('-c', opts.get('--computes', 2)))
+        nodes = int(opts.get('-n', opts.get('--nodes', 10)))
+        failing = int(opts.get('-f', opts.get('--fail', 0)))
+    except (getopt.GetoptError, ValueError) as err:
+        sys.exit("{}\n{}".format(err, usage))
+    if args or computes < 1:
+        sys.exit(usage)
+    param_file = opts.get('-o', opts.get('--parameter-file'))
+
+    RequestHandler.controller = Controller(computes, nodes, failing)
+    server = ThreadingHTTPServer(('127.0.0.1', port), RequestHandler)
+    server.daemon_threads = True
+    threading.Thread(target=RequestHandler.controller.load_updater,
+                     daemon=True).start()
+    url = "http://127.0.0.1:{}".format(port)
+    if param_file:
+        with open(param_file, "w") as file:
+            file.write("{}\n\n\n".format(url))
+    print("Controller {}, project {}".format(url, RequestHandler.controller.project_id))
+    sys.stdout.flush()
+    server.serve_forever()
+
+
+try:
+    main(sys.argv)
+except KeyboardInterrupt:
+    pass
@@ -1,39 +1,872 @@
 #!/usr/local/bin/python3
 
 """
-start_nodes - start nodes of a project one by one
+start_nodes - start nodes of a project, the computes in parallel
+
+Nodes are only started, when their memory demand (the RAM of the node
+properties) fits into the memory of the compute. When the nodes need
+more memory than available, they are started by their memory demand,
+large nodes first. Nodes, that don't fit, are held until memory is
+freed, after the hold time they are skipped. The vCPUs of the nodes
+are not planned, more vCPUs than CPUs only slow the nodes down, the
+CPU load is limited by the admission control.
+
+usage: start_nodes [-p num] [-l limits ...] [-r file] [-w] [--poll]
+                   [--ready] [--ready-prompt=regex] [--ready-timeout=sec]
+                   version parameter-file project-id [sel-item ...]
+
+  -p num, --parallel=num   number of nodes booting at once on each compute
+                           (default 1, one by one)
+  -l limits, --limit=limits
+                           admission limits, format [compute:]key=val,...
+                           keys: cpu, memory (usage in percent),
+                           interval, min_interval, max_interval, step
+                           (seconds between node starts),
+                           hold (seconds waiting for free memory)
+  -r file, --rate-log=file write start rate log (CSV) to file
+  -w, --waves              start in waves based on the topology:
+                           first switches/hubs, then nodes with multiple
+                           links (most links first), then leaf nodes
+  --poll                   poll the compute load, don't use the
+                           notification stream of the controller
+  --ready                  wait until the telnet console of a started node
+                           shows a prompt, instead of a fixed delay
+  --ready-prompt=regex     prompt regex of --ready, implies --ready,
+                           default is a name followed by >, # or $
+                           at the start of a line
+  --ready-timeout=sec      maximum boot time of --ready (default 300)
+
+The compute load and the node status are taken from the notification
+stream of the controller, when it's not available the computes are
+polled. Nodes, that stop or report an error after their start, are
+listed at the end.
+
+With --ready the boot times are listed per node type at the end.
 """
 
+import asyncio
+import collections
+import csv
+import getopt
+import http.client
+import json
 import os
+import re
 import sys
+import threading
 import time
 import gns3api
+from api_helpers import StreamClient, ThreadConnections
+from async_telnet import TelnetClient
+
+print_lock = threading.Lock()
+
+def log(text):
+    """ print a line, the worker threads use it concurrently """
+    with print_lock:
+        print(text)
+        sys.stdout.flush()
+
+DEFAULT_LIMITS = {'cpu': 60.0, 'memory': 85.0, 'interval': 2.0,
+                  'min_interval': 0.5, 'max_interval': 30.0, 'step': 0.5,
+                  'hold': 60.0}
+
+def parse_limits(specs):
+    """
+    parse limit specifications, format [compute:]key=val,...
+
+    Returns a dict compute -> limits, compute None holds the defaults.
+    """
+    limits = {None: dict(DEFAULT_LIMITS)}
+    for spec in specs:
+        compute = None
+        if ':' in spec:
+            compute, spec = spec.split(':', 1)
+        compute_limits = limits.setdefault(compute, {})
+        for item in spec.split(','):
+            key, _, val = item.partition('=')
+            key = key.strip()
+            if key not in DEFAULT_LIMITS:
+                raise ValueError("unknown limit '{}'".format(key))
+            try:
+                compute_limits[key] = float(val)
+            except ValueError:
+                raise ValueError("invalid value of limit '{}'".format(key)) from None
+    return limits
+
+# memory demand in MB, if a node doesn't specify its RAM
+DEFAULT_MEMORY = {'docker': 128, 'dynamips': 256, 'iou': 256, 'qemu': 256,
+                  'virtualbox': 512, 'vmware': 1024, 'vpcs': 16}
+
+def node_memory(node):
+    """ estimated memory demand of a node in MB, vCPUs are not counted """
+    properties = node.get('properties') or {}
+    memory = properties.get('ram') or properties.get('memory')
+    if not memory:
+        memory = DEFAULT_MEMORY.get(node['node_type'], 0)
+    return memory
 
-def start_node_list(api, node_list):
-    """ start nodes, yield sleeps the specified number of seconds """
-    delay_next_node = 0
+def compute_memory(compute, limits):
+    """
+    memory of a compute in MB, returns (usable, used)
+
+    usable is the part of the total memory up to the memory limit,
+    it's None when the compute doesn't report its memory.
+    """
+    total = (compute.get('capabilities') or {}).get('memory')
+    if not total:
+        return (None, None)
+    total /= 1024 * 1024
+    return (total * limits['memory'] / 100.0,
+            total * compute.get('memory_usage_percent', 0.0) / 100.0)
+
+class RateLog:
+    """ start rate log, one CSV line per admission decision """
+
+    def __init__(self, filename):
+        self._file = open(filename, "w", newline='')
+        self._writer = csv.writer(self._file)
+        self._writer.writerow(("time", "compute", "cpu", "memory",
+                               "interval", "action"))
+        self._start = time.monotonic()
+        self._lock = threading.Lock()
+
+    def write(self, compute_id, cpu, memory, interval, action):
+        """ add a log entry """
+        with self._lock:
+            self._writer.writerow(("{:.2f}".format(time.monotonic() - self._start),
+                                   compute_id, cpu, memory,
+                                   "{:.2f}".format(interval), action))
+            self._file.flush()
+
+    def close(self):
+        """ close the log file """
+        with self._lock:
+            self._file.close()
+
+# node types, that are started in the first wave
+INFRASTRUCTURE_TYPES = ('ethernet_switch', 'ethernet_hub', 'frame_relay_switch',
+                        'atm_switch', 'cloud', 'nat')
+
+def topology_waves(node_list, links):
+    """
+    split the nodes into startup waves
+
+    The first wave are switches, hubs and other infrastructure nodes,
+    the second wave are nodes with multiple links (core routers),
+    ordered by their number of links, the last wave are leaf nodes.
+    Within a wave the order of node_list is kept.
+    """
+    degree = {}
+    for link in links:
+        for endpoint in link['nodes']:
+            degree[endpoint['node_id']] = degree.get(endpoint['node_id'], 0) + 1
+    waves = ([], [], [])
     for node in node_list:
-        if delay_next_node > 0:		# delay between starting nodes
-            yield delay_next_node
-        while True:
-            compute = api.request('GET', ('/v2/computes', node['compute_id']))
-            if compute['cpu_usage_percent'] < 60.0:
-                break
-            yield 4			# test again in 4 seconds
-        print("Starting '{}'".format(node['name']))
-        api.request("POST", ("/v2/projects", node['project_id'],
-                             'nodes', node['node_id'], 'start'))
-        if node['node_type'] in ("qemu", "virtualbox", "vmware"):
-            delay_next_node = 4
+        if node['node_type'] in INFRASTRUCTURE_TYPES:
+            waves[0].append(node)
+        elif degree.get(node['node_id'], 0) >= 2:
+            waves[1].append(node)
         else:
-            delay_next_node = 2
+            waves[2].append(node)
+    waves[1].sort(key=lambda node: -degree[node['node_id']])
+    return [wave for wave in waves if wave]
+
+def get_limits(all_limits, compute_id, compute):
+    """ limits of a compute, lookup by compute ID or name """
+    limits = dict(all_limits[None])
+    for key in (compute.get('name'), compute_id):
+        limits.update(all_limits.get(key, {}))
+    return limits
+
+def plan_memory(api, compute_nodes, all_limits):
+    """
+    compare the memory demand of the nodes with the compute capacity
+
+    Prints a summary per compute. When the nodes of a compute need more
+    memory than available, they have to be started by memory demand,
+    large nodes first, the nodes, that won't fit, are listed.
+    Returns the IDs of these computes.
+    """
+    overcommitted = set()
+    for compute_id, node_list in compute_nodes.items():
+        compute = api.request('GET', ('/v2/computes', compute_id))
+        limits = get_limits(all_limits, compute_id, compute)
+        usable, used = compute_memory(compute, limits)
+        demand = sum(node_memory(node) for node in node_list)
+        if usable is None:
+            print("{}: {} nodes, {} MB needed, capacity unknown"
+                  .format(compute.get('name', compute_id),
+                          len(node_list), demand))
+            continue
+        print("{}: {} nodes, {} MB needed, {:.0f} MB available"
+              .format(compute.get('name', compute_id), len(node_list),
+                      demand, max(0, usable - used)))
+        available = usable - used
+        if demand <= available:
+            continue
+        overcommitted.add(compute_id)
+        print("  starting by memory demand, large nodes first")
+        for node in sorted(node_list, key=node_memory, reverse=True):
+            if node_memory(node) > available:
+                print("  '{}' won't fit into memory".format(node['name']))
+            else:
+                available -= node_memory(node)
+    return overcommitted
+
+class AdmissionControl:
+    """
+    adaptive admission control of a compute (AIMD)
+
+    The interval between node starts is doubled, when the CPU or memory
+    usage of the compute exceeds its limit or the current trend would
+    exceed it until the next start. Otherwise the interval is decreased
+    by a constant step.
+    """
+
+    def __init__(self, compute_id, limits, rate_log=None):
+        self.compute_id = compute_id
+        self._all_limits = limits
+        self._limits = None
+        self._rate_log = rate_log
+        self._last = None		# last sample (time, cpu, memory)
+        self._lock = threading.Lock()
+        self._base_memory = None	# used memory before the first start
+        self._reserved = 0		# memory demand of started nodes
+        self._hold_start = None		# time, since when no node fits
+        self.interval = None
+
+    def _get_limits(self, compute):
+        """ limits of this compute, lookup by compute ID or name """
+        return get_limits(self._all_limits, self.compute_id, compute)
+
+    def take(self, queue, compute):
+        """
+        take the first node of the queue, that fits into memory,
+        and reserve its memory demand
+
+        The expected memory usage is the sum of the memory used before
+        the first start and the demand of all started nodes, unless the
+        compute reports a higher usage. Returns (node, None), if a node
+        fits, else (None, available memory in MB).
+        """
+        with self._lock:
+            if not queue:
+                return (None, None)
+            usable, used = compute_memory(compute, self._limits)
+            if usable is None:
+                return (queue.popleft(), None)
+            if self._base_memory is None or used < self._base_memory:
+                self._base_memory = used	# memory freed by others
+            available = usable - max(used, self._base_memory + self._reserved)
+            for node in queue:
+                if node_memory(node) <= available:
+                    queue.remove(node)
+                    self._reserved += node_memory(node)
+                    self._hold_start = None
+                    return (node, None)
+            if self._hold_start is None:
+                self._hold_start = time.monotonic()
+            return (None, max(0, available))
+
+    def hold_expired(self):
+        """ True, if no node fitted into memory during the hold time """
+        with self._lock:
+            return self._hold_start is not None and \
+                time.monotonic() - self._hold_start >= self._limits['hold']
+
+    def take_all(self, queue):
+        """ take the remaining nodes of the queue """
+        with self._lock:
+            nodes = list(queue)
+            queue.clear()
+            return nodes
+
+    def release(self, node):
+        """ release the memory reservation of a stopped node """
+        with self._lock:
+            self._reserved = max(0, self._reserved - node_memory(node))
+
+    def admit(self, compute):
+        """
+        process a load sample of the compute
+
+        Returns True, if a node may be started now.
+        """
+        now = time.monotonic()
+        cpu = compute['cpu_usage_percent']
+        memory = compute.get('memory_usage_percent', 0.0)
+        with self._lock:
+            if self._limits is None:
+                self._limits = self._get_limits(compute)
+                self.interval = self._limits['interval']
+            limits = self._limits
+            if cpu >= limits['cpu'] or memory >= limits['memory']:
+                admit = False
+                action = "wait"
+                self.interval = min(self.interval * 2, limits['max_interval'])
+                if memory >= limits['memory'] and self._hold_start is None:
+                    self._hold_start = now
+            else:
+                admit = True
+                action = "start"
+                if self._last and now - self._last[0] > 0.01:
+                    # expected load at next start, based on the trend
+                    factor = self.interval / (now - self._last[0])
+                    cpu_next = cpu + (cpu - self._last[1]) * factor
+                    mem_next = memory + (memory - self._last[2]) * factor
+                else:
+                    cpu_next, mem_next = cpu, memory
+                if cpu_next >= limits['cpu'] or mem_next >= limits['memory']:
+                    action = "start/backoff"
+                    self.interval = min(self.interval * 2,
+                                        limits['max_interval'])
+                else:
+                    self.interval = max(self.interval - limits['step'],
+                                        limits['min_interval'])
+            self._last = (now, cpu, memory)
+            if self._rate_log:
+                self._rate_log.write(self.compute_id, cpu, memory,
+                                     self.interval, action)
+            return admit
+
+class NotificationWatcher:
+    """
+    live view of the compute load and the node status
+
+    Background threads read the notification streams of the controller
+    (compute updates) and of the project (node updates and errors).
+    When a stream breaks, it's reopened after some seconds.
+    """
+
+    streams = ('/v2/notifications', '/v2/projects/{}/notifications')
+
+    def __init__(self, client, project_id):
+        self._client = client
+        self._cond = threading.Condition()
+        self._connected = set()
+        self._stop = threading.Event()
+        self.computes = {}		# compute_id -> compute information
+        self.nodes = {}			# node_id -> node status
+        self.errors = {}		# node_id -> error message
+        self.acknowledged = set()	# nodes reported as started
+        for path in self.streams:
+            threading.Thread(target=self._reader,
+                             args=(path.format(project_id),),
+                             daemon=True).start()
+
+    def close(self):
+        """ stop reading the notifications """
+        self._stop.set()
+
+    def live(self):
+        """ True, if all notification streams are connected """
+        with self._cond:
+            return len(self._connected) == len(self.streams)
+
+    def wait_live(self, timeout):
+        """ wait until the notification streams are connected """
+        with self._cond:
+            return self._cond.wait_for(
+                lambda: len(self._connected) == len(self.streams), timeout)
+
+    def compute(self, compute_id):
+        """ latest compute information, None if unknown """
+        with self._cond:
+            if len(self._connected) != len(self.streams):
+                return None
+            return self.computes.get(compute_id)
+
+    def wait_compute(self, compute_id, timeout, abort):
+        """
+        wait until the compute is updated, at most timeout seconds
+
+        Returns False when aborted.
+        """
+        end_time = time.monotonic() + timeout
+        with self._cond:
+            current = self.computes.get(compute_id)
+            while not abort.is_set():
+                remaining = end_time - time.monotonic()
+                if remaining <= 0 or self.computes.get(compute_id) is not current:
+                    return True
+                self._cond.wait(min(remaining, 0.2))
+        return False
+
+    def acknowledge(self, node_id):
+        """ mark a node as started, e.g. by the response of its start """
+        with self._cond:
+            self.acknowledged.add(node_id)
+
+    def node_error(self, node_id):
+        """ error message of a node, None if there is no error """
+        with self._cond:
+            return self.errors.get(node_id)
+
+    def node_stopped(self, node_id, final=False):
+        """
+        status of a node, that is not started, else None
+
+        A status before the start acknowledgement is ignored, the node
+        might not have processed the start yet. With final it counts.
+        """
+        with self._cond:
+            status = self.nodes.get(node_id, 'started')
+            if status == 'started' or \
+               not (final or node_id in self.acknowledged):
+                return None
+            return status
+
+    def _handle(self, message):
+        """ process a notification """
+        action = message.get('action')
+        event = message.get('event')
+        if not isinstance(event, dict):
+            return
+        with self._cond:
+            if action in ('compute.created', 'compute.updated'):
+                self.computes[event['compute_id']] = event
+            elif action in ('node.created', 'node.updated'):
+                self.nodes[event['node_id']] = event.get('status')
+                if event.get('status') == 'started':
+                    self.acknowledged.add(event['node_id'])
+                    self.errors.pop(event['node_id'], None)
+            elif action == 'log.error' and event.get('node_id'):
+                self.errors[event['node_id']] = event.get('message', "error")
+            else:
+                return
+            self._cond.notify_all()
+
+    def _reader(self, path):
+        """ thread reading a notification stream """
+        while not self._stop.is_set():
+            conn = self._client.connection()
+            try:
+                resp = self._client.get(path, conn=conn)
+                if resp.status != 200:
+                    raise gns3api.GNS3ApiException(resp.status)
+                with self._cond:
+                    self._connected.add(path)
+                    self._cond.notify_all()
+                for line in resp:
+                    if self._stop.is_set():
+                        break
+                    if line.strip():
+                        self._handle(json.loads(line.decode('utf-8')))
+            except (OSError, ValueError, KeyError, http.client.HTTPException,
+                    gns3api.GNS3ApiException):
+                pass
+            finally:
+                with self._cond:
+                    self._connected.discard(path)
+                conn.close()
+            self._stop.wait(5)
+
+# default prompt of --ready: a name followed by >, # or $ at line start
+READY_PROMPT = r'(?m)^\S*[\w)\]~/][>#$] ?$'
+POKE_IDLE = 3.0		# console idle time, before a <CR> is sent
+
+async def console_prompt(host, port, prompt, end_time, abort):
+    """
+    wait on a telnet console until it shows the prompt
+
+    A <CR> is sent only, when the console was idle for POKE_IDLE
+    seconds. Returns False on timeout or abort, raises OSError or
+    EOFError, when the connection fails.
+    """
+    telnet = TelnetClient()
+    await telnet.open(host, port, 5)
+    try:
+        text = ""
+        idle_since = time.monotonic()
+        while not abort.is_set() and time.monotonic() < end_time:
+            data = await telnet.read_some(0.5)
+            if data:
+                text = (text + data.decode('utf-8', errors='ignore'))[-4096:]
+                if prompt.search(text):
+                    return True
+                idle_since = time.monotonic()
+            elif time.monotonic() - idle_since >= POKE_IDLE:
+                telnet.write(b"\r")
+                await telnet.drain()
+                idle_since = time.monotonic()
+        return False
+    finally:
+        telnet.close()
+
+def wait_console_prompt(host, port, prompt, timeout, abort):
+    """
+    wait until the telnet console shows the prompt
+
+    A refused or closed connection is retried.
+    Returns False on timeout or abort.
+    """
+    end_time = time.monotonic() + timeout
+    while not abort.is_set() and time.monotonic() < end_time:
+        try:
+            return asyncio.run(console_prompt(host, port, prompt,
+                                              end_time, abort))
+        except (OSError, EOFError, asyncio.TimeoutError):
+            pass
+        abort.wait(1)
+    return False
+
+class BootStats:
+    """ boot times of the nodes per node type """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._times = {}
+
+    def add(self, node_type, seconds):
+        """ add the boot time of a node """
+        with self._lock:
+            self._times.setdefault(node_type, []).append(seconds)
+
+    def report(self):
+        """ return table with min/median/p95 per node type """
+        lines = ["{:<16} {:>5} {:>8} {:>8} {:>8}"
+                 .format("node type", "count", "min", "median", "p95")]
+        with self._lock:
+            for node_type, times in sorted(self._times.items()):
+                times = sorted(times)
+                median = times[len(times) // 2]
+                if len(times) % 2 == 0:
+                    median = (median + times[len(times) // 2 - 1]) / 2
+                p95 = times[max(0, -(-len(times) * 95 // 100) - 1)]
+                lines.append("{:<16} {:>5} {:>7.1f}s {:>7.1f}s {:>7.1f}s"
+                             .format(node_type, len(times), times[0],
+                                     median, p95))
+        return "\n".join(lines)
+
+class StartEngine:
+    """
+    start nodes, each compute runs in its own worker threads
+
+    Every compute gets 'parallel' worker threads, each worker with
+    its own API connection. So a slow compute doesn't delay the others
+    and up to 'parallel' nodes are booting at once on each compute.
+    """
+
+    def __init__(self, connect, parallel=1, limits=None, rate_log=None,
+                 watcher=None, ready_prompt=None, ready_timeout=300):
+        self._parallel = max(1, parallel)
+        self._limits = limits or parse_limits(())
+        self._rate_log = rate_log
+        self._watcher = watcher		# NotificationWatcher or None
+        self._ready_prompt = ready_prompt	# compiled regex or None
+        self._ready_timeout = ready_timeout
+        self.boot_stats = BootStats()
+        self.started_nodes = []
+        self._conns = ThreadConnections(connect)	# per worker thread
+        self._lock = threading.Lock()
+        self._abort = threading.Event()
+        self._controls = {}
+        self.error = None
+        self.started = 0
+        self.skipped = 0		# nodes not started, insufficient memory
+        self.request_time = 0.0		# time spent in start requests
+        self._timeline = {}		# one by one time per compute
+        self._next_delay = {}		# delay after the last start per compute
+        self._waiting = {}		# compute -> [waiting workers, since]
+
+    def request(self, *args):
+        """ API request """
+        return self._conns.request(*args)
+
+    def delay(self, seconds):
+        """ sleep some seconds, returns False when aborted """
+        return not self._abort.wait(seconds)
+
+    def compute(self, compute_id):
+        """ compute information, from the notifications or polled """
+        compute = None
+        if self._watcher:
+            compute = self._watcher.compute(compute_id)
+        if compute is None:
+            compute = self.request('GET', ('/v2/computes', compute_id))
+        return compute
+
+    def wait_compute(self, compute_id, seconds):
+        """
+        wait until the compute load changes, at most some seconds
+
+        Returns False when aborted.
+        """
+        if not self._watcher or not self._watcher.live():
+            return self.delay(seconds)
+        return self._watcher.wait_compute(compute_id, seconds, self._abort)
+
+    def node_failed(self, node, final=False):
+        """
+        error message, if a started node failed, else None
+
+        A node, that isn't started according to the notifications,
+        is checked by querying its status.
+        """
+        message = self._watcher.node_error(node['node_id'])
+        if message:
+            return message
+        if self._watcher.node_stopped(node['node_id'], final) is None:
+            return None
+        try:
+            status = self.request('GET', ('/v2/projects', node['project_id'],
+                                          'nodes', node['node_id']))['status']
+        except gns3api.GNS3ApiException as err:
+            return "can't get node status: {}".format(err)
+        if status == 'started':
+            return None
+        return "node is {}".format(status)
+
+    def failed_nodes(self):
+        """ started nodes, that failed, list of (node, message) """
+        if not self._watcher or not self._watcher.live():
+            return []
+        failed = []
+        for node in self.started_nodes:
+            message = self.node_failed(node, final=True)
+            if message:
+                failed.append((node, message))
+        return failed
+
+    def wait_ready(self, node, compute):
+        """
+        wait until a started node shows its console prompt
+
+        Returns True, when the node is ready, False on timeout and
+        None, if the node has no telnet console.
+        """
+        if not node.get('console') or node.get('console_type') != 'telnet':
+            return None
+        host = node.get('console_host')
+        if not host or host in ('0.0.0.0', '::'):
+            host = compute['host']
+        start = time.monotonic()
+        ready = wait_console_prompt(host, node['console'], self._ready_prompt,
+                                    self._ready_timeout, self._abort)
+        seconds = time.monotonic() - start
+        if ready:
+            self.boot_stats.add(node['node_type'], seconds)
+            log("'{}' booted in {:.1f}s".format(node['name'], seconds))
+        elif not self._abort.is_set():
+            log("'{}' not ready after {:.0f}s".format(node['name'], seconds))
+        return ready
+
+    def serial_estimate(self):
+        """
+        estimate the wall-clock time of the one by one mode
+
+        One by one the nodes of a compute are started serially, the
+        admission waits and the delays between the starts add up.
+        The computes run side by side, but every start request blocks
+        all of them. Waiting for the console prompt is not counted,
+        the one by one mode doesn't do it.
+        """
+        with self._lock:
+            return self.request_time + max(self._timeline.values(), default=0.0)
+
+    def _account_wait(self, compute_id, waiting):
+        """
+        account the begin or end of an admission wait of a worker
+
+        The waits of the workers of a compute overlap, only the time,
+        in which any of them is waiting, counts.
+        """
+        now = time.monotonic()
+        with self._lock:
+            state = self._waiting.setdefault(compute_id, [0, now])
+            if waiting:
+                if state[0] == 0:
+                    state[1] = now
+                state[0] += 1
+            else:
+                state[0] -= 1
+                if state[0] == 0:
+                    self._timeline[compute_id] = \
+                        self._timeline.get(compute_id, 0.0) + now - state[1]
+
+    def _account_start(self, compute_id, request_time, delay):
+        """
+        account a node start, its request time and the delay before
+        the next start, the delay of the last start is not counted
+        """
+        with self._lock:
+            self.request_time += request_time
+            self._timeline[compute_id] = self._timeline.get(compute_id, 0.0) + \
+                                         self._next_delay.get(compute_id, 0.0)
+            self._next_delay[compute_id] = delay
+
+    def _control(self, compute_id):
+        """ admission control of a compute, kept across multiple runs """
+        with self._lock:
+            control = self._controls.get(compute_id)
+            if control is None:
+                control = AdmissionControl(compute_id, self._limits,
+                                           self._rate_log)
+                self._controls[compute_id] = control
+            return control
+
+    def run(self, compute_nodes, settle=False):
+        """
+        start the nodes, compute_nodes is a dict compute_id -> nodes
+
+        With settle the workers wait the delay of their last node,
+        so that all nodes have booted when run returns.
+        """
+        threads = []
+        for compute_id, node_list in compute_nodes.items():
+            queue = collections.deque(node_list)
+            control = self._control(compute_id)
+            for _ in range(min(self._parallel, len(node_list))):
+                threads.append(threading.Thread(target=self._worker,
+                                                args=(control, queue, settle),
+                                                daemon=True))
+        try:
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                while thread.is_alive():
+                    thread.join(0.2)
+        except BaseException:
+            self._abort.set()
+            raise
+        if self.error:
+            raise self.error
+
+    def _worker(self, control, queue, settle):
+        """ worker thread, starts the nodes of a compute one by one """
+        compute_id = control.compute_id
+        delay_next_node = 0
+        last_node = None
+        try:
+            while queue and not self._abort.is_set():
+                if delay_next_node > 0:	# delay between starting nodes
+                    if not self.delay(delay_next_node):
+                        break
+                    delay_next_node = 0
+                if last_node and self._watcher:
+                    message = self.node_failed(last_node)
+                    if message:
+                        log("Node '{}' failed: {}".format(last_node['name'],
+                                                          message))
+                        control.release(last_node)
+                    last_node = None
+                waiting = False
+                try:
+                    while True:
+                        compute = self.compute(compute_id)
+                        if control.admit(compute):
+                            node, available = control.take(queue, compute)
+                            if node or available is None:
+                                break
+                        if control.hold_expired():
+                            node = None
+                            break
+                        # wait for a lower load, hold the nodes until memory is freed
+                        if not waiting:
+                            self._account_wait(compute_id, True)
+                            waiting = True
+                        if not self.wait_compute(compute_id, control.interval):
+                            return
+                finally:
+                    if waiting:
+                        self._account_wait(compute_id, False)
+                if node is None:
+                    for node in control.take_all(queue):
+                        log("Not starting '{}', needs {} MB, memory exhausted"
+                            .format(node['name'], node_memory(node)))
+                        with self._lock:
+                            self.skipped += 1
+                    break
+                log("Starting '{}'".format(node['name']))
+                start = time.monotonic()
+                result = self.request("POST", ("/v2/projects", node['project_id'],
+                                               'nodes', node['node_id'], 'start'))
+                if node['node_type'] in ("qemu", "virtualbox", "vmware"):
+                    delay_next_node = 2 * control.interval
+                else:
+                    delay_next_node = control.interval
+                self._account_start(compute_id, time.monotonic() - start,
+                                    delay_next_node)
+                if self._watcher and isinstance(result, dict) and \
+                   result.get('status') == 'started':
+                    self._watcher.acknowledge(node['node_id'])
+                with self._lock:
+                    self.started += 1
+                    self.started_nodes.append(node)
+                last_node = node
+                if self._ready_prompt:
+                    if isinstance(result, dict) and result.get('node_id'):
+                        node = result
+                    if self.wait_ready(node, compute) is not None:
+                        delay_next_node = 0
+                        continue	# slot was held until node has booted
+            if settle and delay_next_node > 0 and not self._abort.is_set():
+                self.delay(delay_next_node)
+        except (gns3api.GNS3ApiException, OSError) as err:
+            with self._lock:
+                if self.error is None:
+                    self.error = err
+            self._abort.set()
 
 def start_nodes(argv):
-    """ parse command line, retrieve nodes and start nodes one by one """
+    """ parse command line, retrieve nodes and start them """
 
     # get arguments
+    usage = "usage:\nstart_nodes [-p num] [-l limits ...] [-r file] [-w] [--poll] " \
+            "[--ready] [--ready-prompt=regex] [--ready-timeout=sec] " \
+            "version parameter-file project-id [sel-item ...]"
+    try:
+        opts, args = getopt.getopt(argv[1:], "p:l:r:w",
+                                   ["parallel=", "limit=", "rate-log=",
+                                    "waves", "poll", "ready", "ready-prompt=",
+                                    "ready-timeout="])
+    except getopt.GetoptError as err:
+        sys.exit("{}\n{}".format(err, usage))
+    parallel = 1
+    waves = False
+    poll = False
+    ready_prompt = None
+    ready_timeout = 300
+    limit_specs = []
+    rate_log_file = None
+    for opt, val in opts:
+        if opt in ("-p", "--parallel"):
+            try:
+                parallel = int(val)
+            except ValueError:
+                parallel = 0
+            if parallel < 1:
+                sys.exit("Number of parallel nodes must be a positive integer")
+        elif opt in ("-l", "--limit"):
+            limit_specs.append(val)
+        elif opt in ("-r", "--rate-log"):
+            rate_log_file = val
+        elif opt in ("-w", "--waves"):
+            waves = True
+        elif opt == "--poll":
+            poll = True
+        elif opt == "--ready":
+            ready_prompt = ready_prompt or READY_PROMPT
+        elif opt == "--ready-prompt":
+            ready_prompt = val
+        elif opt == "--ready-timeout":
+            try:
+                ready_timeout = float(val)
+            except ValueError:
+                sys.exit("Invalid ready timeout '{}'".format(val))
+    if ready_prompt:
+        try:
+            ready_prompt = re.compile(ready_prompt)
+        except re.error as err:
+            sys.exit("Invalid ready prompt: {}".format(err))
+    try:
+        limits = parse_limits(limit_specs)
+    except ValueError as err:
+        sys.exit("Invalid limit: {}".format(err))
+    argv = argv[:1] + args
     if len(argv) < 4:
-        sys.exit("usage:\nstart_nodes version parameter-file project-id [sel-item ...]")
+        sys.exit(usage)
     try:
         with open(argv[2], "r") as file:
             cntl_url, cntl_user, cntl_passwd, *_ = file.read(512).splitlines()
@@ -71,33 +904,91 @@ def start_nodes(argv):
 
     sel_nodes.sort(key=lambda k: nodes[k]['name'].lower())
 
-    # create nodes list per compute
+    # create startup waves, each with a nodes list per compute
+    node_list = [nodes[node_id] for node_id in sel_nodes
+                 if nodes[node_id]['status'] != 'started']
+    if waves:
+        try:
+            links = api.request('GET', ('/v2/projects', project_id, 'links'))
+        except gns3api.GNS3ApiException as err:
+            sys.exit("Can't get link information: {}".format(err))
+        wave_list = topology_waves(node_list, links)
+    else:
+        wave_list = [node_list]
+    wave_compute_nodes = []
     compute_nodes = {}
-    for node_id in sel_nodes:
-        node = nodes[node_id]
-        if node['status'] != 'started':
+    for wave in wave_list:
+        wave_nodes = {}
+        for node in wave:
+            wave_nodes.setdefault(node['compute_id'], []).append(node)
             compute_nodes.setdefault(node['compute_id'], []).append(node)
+        wave_compute_nodes.append(wave_nodes)
 
-    # iterate through compute_nodes and start them
-    print("Starting nodes one by one")
-    tasks = {compute_id: {
-                'iter': start_node_list(api, compute_nodes[compute_id]),
-                'delay': 0}
-             for compute_id in compute_nodes}
-    while tasks:
-        delay = min([tasks[compute_id]['delay'] for compute_id in tasks])
-        if delay > 0.09:
-            time.sleep(delay)
-        for compute_id in list(tasks.keys()):
-            tasks[compute_id]['delay'] -= delay
-            if tasks[compute_id]['delay'] <= 0.09:
-                try:
-                    tasks[compute_id]['delay'] = \
-                        max(0, next(tasks[compute_id]['iter']))
-                except StopIteration:
-                    del tasks[compute_id]
-                except gns3api.GNS3ApiException as err:
-                    sys.exit("Can't start node: {}".format(err))
+    # start the nodes, the computes run in parallel
+    if parallel == 1:
+        print("Starting nodes one by one")
+    else:
+        print("Starting nodes, up to {} at once per compute".format(parallel))
+    rate_log = None
+    try:
+        if rate_log_file:
+            rate_log = RateLog(rate_log_file)
+    except OSError as err:
+        sys.exit("Can't create rate log: {}".format(err))
+    watcher = None
+    if not poll:
+        try:
+            client = StreamClient(cntl_url, cntl_user, cntl_passwd)
+        except gns3api.GNS3ApiException as err:
+            sys.exit("Can't connect to GNS3 controller: {}".format(err))
+        watcher = NotificationWatcher(client, project_id)
+        if not watcher.wait_live(5):
+            print("Notification stream not available, polling the computes")
+            watcher.close()
+            watcher = None
+    engine = StartEngine(lambda: gns3api.GNS3Api(cntl_url, cntl_user, cntl_passwd),
+                         parallel, limits, rate_log, watcher,
+                         ready_prompt, ready_timeout)
+    start_time = time.monotonic()
+    try:
+        overcommitted = plan_memory(api, compute_nodes, limits)
+        for wave_nodes in wave_compute_nodes:
+            for compute_id in overcommitted.intersection(wave_nodes):
+                wave_nodes[compute_id].sort(key=node_memory, reverse=True)
+        for num, wave_nodes in enumerate(wave_compute_nodes):
+            if waves:
+                print("Wave {} of {}".format(num+1, len(wave_compute_nodes)))
+            engine.run(wave_nodes, settle=num < len(wave_compute_nodes) - 1)
+    except gns3api.GNS3ApiException as err:
+        sys.exit("Can't start node: {}".format(err))
+    except OSError as err:
+        sys.exit("I/O error: {}".format(err))
+    finally:
+        if rate_log:
+            rate_log.close()
+    elapsed = time.monotonic() - start_time
+    if engine.started:
+        serial = engine.serial_estimate()
+        print("Started {} nodes in {:.1f}s, one by one about {:.1f}s, saved {:.1f}s"
+              .format(engine.started, elapsed, serial, serial - elapsed))
+    if ready_prompt and engine.started:
+        print()
+        print(engine.boot_stats.report())
+    if watcher and engine.started:
+        time.sleep(2)			# allow late status updates
+    failed = engine.failed_nodes()
+    if watcher:
+        watcher.close()
+    errors = []
+    if engine.skipped:
+        errors.append("{} nodes not started, insufficient memory"
+                      .format(engine.skipped))
+    if failed:
+        errors.append("{} nodes failed to start: {}"
+                      .format(len(failed),
+                              ", ".join(node['name'] for node, _ in failed)))
+    if errors:
+        sys.exit("\n".join(errors))
 
 
 try:
@@ -0,0 +1,113 @@
+"""
+topology.py - index of the links of a GNS3 project
+
+The index maps the nodes to their links and the links to their
+endpoints. The links are stored as compact records, only the
+attributes needed by the tools are kept.
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+from api_helpers import ThreadConnections
+
+class Link:
+    """ link record """
+
+    __slots__ = ('link_id', 'suspend', 'filters', 'endpoints')
+
+    def __init__(self, link_id, suspend, filters, endpoints):
+        self.link_id = link_id
+        self.suspend = suspend
+        self.filters = filters		# packet filters, dict
+        self.endpoints = endpoints	# tuple of (node_id, adapter, port)
+
+    @classmethod
+    def from_api(cls, link):
+        """ create a record from a link returned by the API """
+        return cls(link['link_id'], link.get('suspend', False),
+                   link.get('filters') or {},
+                   tuple((node['node_id'], node['adapter_number'],
+                          node['port_number']) for node in link['nodes']))
+
+    def to_list(self):
+        """ compact representation, used in files """
+        return [self.link_id, self.suspend, self.filters,
+                [list(endpoint) for endpoint in self.endpoints]]
+
+    @classmethod
+    def from_list(cls, data):
+        """ create a record from its compact representation """
+        link_id, suspend, filters, endpoints = data
+        return cls(link_id, suspend, filters,
+                   tuple(tuple(endpoint) for endpoint in endpoints))
+
+class Topology:
+    """ node -> links and link -> endpoints index """
+
+    def __init__(self, links=()):
+        self.links = {}			# link_id -> Link
+        self.node_links = {}		# node_id -> set of link_ids
+        self._by_endpoints = {}		# frozenset of endpoints -> link_id
+        for link in links:
+            self.add(link)
+
+    def add(self, link):
+        """ add a link, either a Link or a link returned by the API """
+        if not isinstance(link, Link):
+            link = Link.from_api(link)
+        self.links[link.link_id] = link
+        self._by_endpoints[frozenset(link.endpoints)] = link.link_id
+        for node_id, _, _ in link.endpoints:
+            self.node_links.setdefault(node_id, set()).add(link.link_id)
+        return link
+
+    def remove(self, link_id):
+        """ remove a link """
+        link = self.links.pop(link_id)
+        self._by_endpoints.pop(frozenset(link.endpoints), None)
+        for node_id, _, _ in link.endpoints:
+            self.node_links[node_id].discard(link_id)
+        return link
+
+    def links_of(self, node_ids):
+        """ return the links connected to any of the nodes """
+        link_ids = set()
+        for node_id in node_ids:
+            link_ids.update(self.node_links.get(node_id, ()))
+        return [self.links[link_id] for link_id in link_ids]
+
+    def find(self, link):
+        """
+        find a link, first by its link_id, then by its endpoints
+
+        Returns the Link of this topology or None.
+        """
+        if link.link_id in self.links:
+            return self.links[link.link_id]
+        link_id = self._by_endpoints.get(frozenset(link.endpoints))
+        return self.links[link_id] if link_id else None
+
+    @classmethod
+    def from_project(cls, api, project_id):
+        """ get the links of a project """
+        return cls(api.request('GET', ('/v2/projects', project_id, 'links')))
+
+    @classmethod
+    def from_nodes(cls, connect, project_id, node_ids, jobs=8):
+        """
+        get the links of some nodes, the nodes are queried concurrently
+
+        connect is a function returning a new API connection.
+        """
+        conns = ThreadConnections(connect)
+
+        def node_links(node_id):
+            return conns.request('GET', ('/v2/projects', project_id,
+                                         'nodes', node_id, 'links'))
+
+        topology = cls()
+        with ThreadPoolExecutor(max_workers=jobs) as executor:
+            for links in executor.map(node_links, node_ids):
+                for link in links:
+                    if link['link_id'] not in topology.links:
+                        topology.add(link)
+        return topology